@@ -12,34 +12,68 @@
 # along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
 
 from __future__ import division, print_function
-from tf_unet import unet, image_util, util
+from tf_unet import unet, image_util, util, augment
 import numpy as np
 import os
 import h5py
 import scipy.io as sio
 
-# Train
-os.system('rm -rf /data/XIAOYUN_ZHOU/Marker_Seg/Trained_1/prediction/*') # remove the saved predictions in your last training
-os.system('rm -rf /data/XIAOYUN_ZHOU/Marker_Seg/Trained_1/parameter/*') # remove the saved models in your last training
-Unet_path = "/data/XIAOYUN_ZHOU/Marker_Seg/Trained_1/parameter/" # specify the saving path for trained models
-Data_path = "/data/XIAOYUN_ZHOU/CodeRelease/IROS2018/Data/Train/" # specify the path for training images
-Train_num = 80*72
-Veri_num = 7*72
+# The spawned workers of the data-parallel training re-import this script, hence the
+# training only runs when it is executed directly
+if __name__ == "__main__":
+    # Train
+    os.system('rm -rf /data/XIAOYUN_ZHOU/Marker_Seg/Trained_1/prediction/*') # remove the saved predictions in your last training
+    os.system('rm -rf /data/XIAOYUN_ZHOU/Marker_Seg/Trained_1/parameter/*') # remove the saved models in your last training
+    Unet_path = "/data/XIAOYUN_ZHOU/Marker_Seg/Trained_1/parameter/" # specify the saving path for trained models
+    Data_path = "/data/XIAOYUN_ZHOU/CodeRelease/IROS2018/Data/Train/" # specify the path for training images
+    Restore_path = "/data/XIAOYUN_ZHOU/Marker_Seg/Trained_1/restore" # specify the checkpoint to continue from if restore=True
+    Train_num = 80*72
+    Veri_num = 7*72
+    augmenter = None
+    # Only the original images are needed if the augmentation is done while loading
+    # Train_num = 80
+    # Veri_num = 7
+    # augmenter = augment.BatchAugmenter(rotation=180, scale_range=(0.8, 1.2))
 
-net = unet.Unet(channels=1, n_class=6, layers=3, features_root=64,
-                cost_kwargs=dict(fore_weights=1.0, back_weights=1.0))
+    net = unet.Unet(channels=1, n_class=6, layers=3, features_root=64,
+                    cost_kwargs=dict(fore_weights=1.0, back_weights=1.0))
+    # switch to the focal loss after the first training step without restarting
+    # net = unet.Unet(channels=1, n_class=6, layers=3, features_root=64,
+    #                 cost_kwargs=dict(fore_weights=1.0, back_weights=1.0, focal_start_step=100000))
 
-trainer = unet.Trainer(net, optimizer="momentum",
-                       opt_kwargs=dict(momentum=0.9,
-                                       learning_rate_step=[10000000],
-                                       learning_rate_value=[0.01, 0.1]))
+    trainer = unet.Trainer(net, optimizer="momentum",
+                           opt_kwargs=dict(momentum=0.9,
+                                           learning_rate_step=[10000000],
+                                           learning_rate_value=[0.01, 0.1]))
+    # larger effective batches at the memory of batch_size=1, the gradients of 4 micro-batches are averaged per update
+    # trainer = unet.Trainer(net, optimizer="momentum", accumulation_steps=4,
+    #                        opt_kwargs=dict(momentum=0.9,
+    #                                        learning_rate_step=[10000000],
+    #                                        learning_rate_value=[0.01, 0.1]))
 
-path = trainer.train(Unet_path, Data_path, Train_num, Veri_num,
-                     training_iters=200, epochs=50000, restore=False)
+    path = trainer.train(Unet_path, Data_path, Train_num, Veri_num,
+                         training_iters=200, epochs=50000, restore=False, augmenter=augmenter,
+                         restore_path=Restore_path,
+                         checkpoint_kwargs=dict(max_to_keep=5, keep_best=1, metric="mean_dice", save_secs=600))
+
+    # Data-parallel training with one worker process per socket or group of cores, the workers
+    # average their gradients after every step, i.e. every step trains on 4 * batch_size images
+    # (uncomment for use instead of the trainer above, the net is built in the workers)
+    # from tf_unet import parallel
+    # import functools
+    # net_fn = functools.partial(unet.Unet, channels=1, n_class=6, layers=3, features_root=64,
+    #                            cost_kwargs=dict(fore_weights=1.0, back_weights=1.0))
+    # path = parallel.train_parallel(net_fn, Unet_path, Data_path, Train_num, Veri_num, num_workers=4,
+    #                                trainer_kwargs=dict(optimizer="momentum",
+    #                                                    opt_kwargs=dict(momentum=0.9,
+    #                                                                    learning_rate_step=[10000000],
+    #                                                                    learning_rate_value=[0.01, 0.1])),
+    #                                training_iters=200, epochs=50000, restore=False)
 
 # # Test
 # Save_path = '/data/XIAOYUN_ZHOU/Marker_Seg/Test/result/' # please specify this file for saveing results
 # Data_path = "/data/XIAOYUN_ZHOU/CodeRelease/IROS2018/Data/" # please specify this file to your test data file
+# Restore_path = "/data/XIAOYUN_ZHOU/CodeRelease/IROS2018/TrainedModels" # please specify the trained model
 # # Load testing data
 # net = unet.Unet(channels=1, n_class=6, layers=3, features_root=64,
 #                 cost_kwargs=dict(fore_weights=1.0, back_weights=1.0))
@@ -51,16 +85,15 @@ path = trainer.train(Unet_path, Data_path, Train_num, Veri_num,
 # Label_test = Label_t['Marker_label_test_multipleclass']
 #
 # prediction = np.zeros((Image_test.shape[0], Image_size, Image_size, N_class))
-# img = np.zeros((Image_size, Image_size*3,3,N_class))
 #
 # for i in range(0, np.shape(Image_test)[0]):
 #     x_test = np.reshape(Image_test[i, ...], (1, Image_size, Image_size, 1))
-#     pred = net.predict(x_test)
+#     pred = net.predict(x_test, Restore_path)
 #     y_test = np.reshape(Label_test[i, ...], (1, Image_size, Image_size, N_class))
 #     prediction[i, ...] = pred
-#     img[...,0],img[...,1],img[...,2],img[...,3],img[...,4],img[...,5]=util.combine_img_prediction(x_test,y_test,pred)
-#     for j in range(0,6):
-#         util.save_image(img[...,j], (Save_path+"%s_%s.jpg"%(i+1,j)))
+#     img = util.combine_img_prediction(x_test, y_test, pred)
+#     for j in range(0, N_class):
+#         util.save_image(img[j], (Save_path+"%s_%s.jpg"%(i+1,j)))
 # Marker_Seg = {}
 # Marker_Seg['Marker_Seg'] = prediction
 # sio.savemat(Save_path+'Marker_Seg.mat', Marker_Seg)
\ No newline at end of file
@@ -0,0 +1,28 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+from tf_unet import benchmark
+
+
+class TestBenchmark(object):
+
+    def test_run_config(self):
+        result = benchmark.run_config(32, layers=2, features_root=4, n_class=2, batch_size=1, threads=1,
+                                      train_steps=1, inference_batches=1, warmup=0, verification_batch_size=1)
+
+        assert result["size"] == 32
+        assert result["train_steps_per_sec"] > 0
+        assert result["inference_images_per_sec"] > 0
+        assert len(result["verification_dice"]) == 2
@@ -0,0 +1,38 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import numpy as np
+
+from tf_unet import image_util
+from tf_unet import augment
+
+
+class TestBaseDataProvider(object):
+
+    def test_augment_index_labels(self):
+        data = np.random.rand(1, 16, 16, 1).astype(np.float32)
+        label = np.ones((1, 16, 16), dtype=np.uint8)
+        provider = image_util.SimpleDataProvider(data, label, n_class=2)
+        provider.label_format = "index"
+        # zooming out by 2 maps the border of the output from outside the image
+        provider.augmenter = augment.BatchAugmenter(rotation=0, flip=False, scale_range=(0.5, 0.5))
+
+        _, batch_y = provider(1)
+
+        assert batch_y.shape == (1, 16, 16)
+        assert batch_y[0, 0, 0] == 0
+        assert batch_y[0, 15, 15] == 0
+        assert batch_y[0, 8, 8] == 1
+        assert set(np.unique(batch_y)) == set([0, 1])
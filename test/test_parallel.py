@@ -0,0 +1,40 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import os
+import functools
+
+from tf_unet import unet
+from tf_unet import image_gen
+from tf_unet import parallel
+
+
+class TestParallel(object):
+
+    def test_count_parameters(self):
+        net_fn = functools.partial(unet.Unet, channels=1, n_class=2, layers=2, features_root=4)
+        assert parallel.count_parameters(net_fn) > 0
+
+    def test_train_parallel(self, tmpdir):
+        net_fn = functools.partial(unet.Unet, channels=1, n_class=2, layers=2, features_root=4, summaries=False)
+        provider = image_gen.GrayScaleDataProvider(32, 32, border=4, r_max=8)
+        output_path = str(tmpdir.join("parameter"))
+
+        path = parallel.train_parallel(net_fn, output_path, provider, 1, 1, num_workers=2,
+                                       trainer_kwargs=dict(prediction_path=str(tmpdir.join("prediction"))),
+                                       threads_per_worker=1, training_iters=1, epochs=1)
+
+        assert path is not None
+        assert os.path.exists(path + ".index")
@@ -0,0 +1,138 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+On-the-fly data augmentation of whole numpy batches. Every sample gets its
+own random rotation, flip, scaling and intensity jitter, the labels undergo
+the same geometric transform as the images.
+
+Usage:
+augmenter = BatchAugmenter(rotation=180, scale_range=(0.8, 1.2))
+batch_x, batch_y = augmenter(batch_x, batch_y)
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import numpy as np
+
+
+class BatchAugmenter(object):
+    """
+    Randomly augments batches of shape [n, nx, ny, channels] and labels of shape [n, nx, ny, n_class]
+    or class index labels of shape [n, nx, ny]. Pixels mapped from outside the image are set to zero
+    and labeled as background.
+
+    :param rotation: (optional) maximal rotation angle in degrees
+    :param flip: (optional) Flag if the samples should be mirrored at random
+    :param scale_range: (optional) range of the random scaling factor
+    :param gain_range: (optional) range of the random intensity gain
+    :param shift_range: (optional) range of the random intensity offset
+    :param background_channel: (optional) label channel or index of the background class
+    """
+
+    def __init__(self, rotation=180, flip=True, scale_range=(0.9, 1.1), gain_range=(0.9, 1.1), shift_range=(-0.05, 0.05),
+                 background_channel=0):
+        self.rotation = rotation
+        self.flip = flip
+        self.scale_range = scale_range
+        self.gain_range = gain_range
+        self.shift_range = shift_range
+        self.background_channel = background_channel
+
+    def _source_coordinates(self, n, nx, ny):
+        """
+        Maps the output pixel grid back into the input images
+
+        :returns rows, cols: source coordinates of shape [n, nx*ny]
+        """
+        angles = np.deg2rad(np.random.uniform(-self.rotation, self.rotation, n))
+        scales = np.random.uniform(self.scale_range[0], self.scale_range[1], n)
+        mirror = np.where(np.random.rand(n) < 0.5, -1.0, 1.0) if self.flip else np.ones(n)
+
+        # inverse transform: rotate back, mirror and undo the scaling
+        cos = np.cos(angles) / scales
+        sin = np.sin(angles) / scales
+        inverse = np.empty((n, 2, 2))
+        inverse[:, 0, 0] = cos
+        inverse[:, 0, 1] = sin
+        inverse[:, 1, 0] = -sin * mirror
+        inverse[:, 1, 1] = cos * mirror
+
+        center = np.array([(nx - 1) / 2, (ny - 1) / 2])
+        rows, cols = np.mgrid[0:nx, 0:ny]
+        grid = np.stack((rows.ravel(), cols.ravel())) - center[:, np.newaxis]
+
+        source = np.einsum("nij,jp->nip", inverse, grid) + center[np.newaxis, :, np.newaxis]
+        return source[:, 0], source[:, 1]
+
+    def _interpolate(self, batch_x, rows, cols):
+        """
+        Bilinear interpolation of the images at the given coordinates
+        """
+        n, nx, ny, channels = batch_x.shape
+        row0 = np.floor(rows).astype(np.int64)
+        col0 = np.floor(cols).astype(np.int64)
+        row_weight = (rows - row0)[..., np.newaxis]
+        col_weight = (cols - col0)[..., np.newaxis]
+        samples = np.arange(n)[:, np.newaxis]
+
+        result = np.zeros((n, rows.shape[1], channels), dtype=np.float32)
+        for dr, dc, weight in ((0, 0, (1 - row_weight) * (1 - col_weight)),
+                               (0, 1, (1 - row_weight) * col_weight),
+                               (1, 0, row_weight * (1 - col_weight)),
+                               (1, 1, row_weight * col_weight)):
+            r = row0 + dr
+            c = col0 + dc
+            inside = ((r >= 0) & (r < nx) & (c >= 0) & (c < ny))[..., np.newaxis]
+            values = batch_x[samples, np.clip(r, 0, nx - 1), np.clip(c, 0, ny - 1)]
+            result += np.where(inside, weight * values, 0)
+
+        return result.reshape(n, nx, ny, channels)
+
+    def _nearest(self, batch_y, rows, cols):
+        """
+        Nearest neighbour lookup of the labels at the given coordinates
+        """
+        n, nx, ny = batch_y.shape[:3]
+        r = np.rint(rows).astype(np.int64)
+        c = np.rint(cols).astype(np.int64)
+        outside = (r < 0) | (r >= nx) | (c < 0) | (c >= ny)
+
+        result = batch_y[np.arange(n)[:, np.newaxis], np.clip(r, 0, nx - 1), np.clip(c, 0, ny - 1)]
+        if batch_y.ndim == 3:
+            result[outside] = self.background_channel
+        else:
+            result[outside] = 0
+            result[outside, self.background_channel] = 1
+        return result.reshape(batch_y.shape)
+
+    def __call__(self, batch_x, batch_y):
+        """
+        Augments the batch
+
+        :param batch_x: images of shape [n, nx, ny, channels]
+        :param batch_y: labels of shape [n, nx, ny, n_class] or [n, nx, ny]
+
+        :returns batch_x, batch_y: the augmented batch
+        """
+        n, nx, ny = batch_x.shape[:3]
+        rows, cols = self._source_coordinates(n, nx, ny)
+
+        batch_x = self._interpolate(batch_x, rows, cols)
+        batch_y = self._nearest(batch_y, rows, cols)
+
+        gain = np.random.uniform(self.gain_range[0], self.gain_range[1], (n, 1, 1, 1))
+        shift = np.random.uniform(self.shift_range[0], self.shift_range[1], (n, 1, 1, 1))
+        batch_x *= gain
+        batch_x += shift
+        return batch_x, batch_y
@@ -0,0 +1,235 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Dynamic batching in front of a predictor. Single images submitted by many
+callers are queued in buckets of equal shape, a bucket is flushed as one batch
+once it is full or its oldest request reaches the latency deadline.
+
+Usage:
+with DynamicBatcher(Predictor(net, "trained_models/"), max_batch_size=8, max_latency_ms=10) as batcher:
+    prediction = batcher.predict(image)
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import time
+import threading
+from collections import OrderedDict, Counter, deque
+
+import numpy as np
+
+from tf_unet import util
+
+
+class Request(object):
+    """
+    Pending prediction of a single image
+    """
+
+    def __init__(self, image):
+        self.image = image
+        self.arrival = time.time()
+        self.result = None
+        self.error = None
+        self._done = threading.Event()
+
+    def _finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the prediction is available
+
+        :returns prediction: class probabilities of shape [nx, ny, n_class]
+        """
+        if not self._done.wait(timeout):
+            raise RuntimeError("Prediction timed out")
+        if self.error is not None:
+            raise self.error
+        return self.result
+
+
+class DynamicBatcher(object):
+    """
+    Groups single image requests by shape into batches
+
+    :param predict_fn: callable mapping a batch [n, nx, ny, channels] to class probabilities, e.g. a predictor.Predictor
+    :param max_batch_size: (optional) maximal number of images per batch
+    :param max_latency_ms: (optional) maximal time a request waits for its batch to fill up
+    :param num_workers: (optional) number of batches run concurrently
+    :param window: (optional) number of recent requests the latency statistics are computed on
+    """
+
+    def __init__(self, predict_fn, max_batch_size=8, max_latency_ms=10, num_workers=1, window=10000):
+        self.predict_fn = predict_fn
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+        self.num_workers = num_workers
+
+        self._buckets = OrderedDict()
+        self._pending = 0
+        self._condition = threading.Condition()
+        self._running = False
+        self._workers = []
+
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=window)
+        self.request_count = 0
+
+    def start(self):
+        """
+        Starts the workers flushing the batches
+        """
+        if self._running:
+            return self
+
+        self._running = True
+        for _ in range(self.num_workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+        return self
+
+    def submit(self, image):
+        """
+        Queues a single image
+
+        :param image: the image of shape [nx, ny, channels]
+
+        :returns request: the pending request, see Request.wait
+        """
+        if not self._running:
+            self.start()
+
+        request = Request(image)
+        with self._condition:
+            self._buckets.setdefault(image.shape, []).append(request)
+            self._pending += 1
+            self.request_count += 1
+            self._condition.notify()
+        return request
+
+    def predict(self, image, timeout=None):
+        """
+        Predicts a single image, blocks until its batch is done
+
+        :returns prediction: class probabilities of shape [nx, ny, n_class]
+        """
+        return self.submit(image).wait(timeout)
+
+    def _take_batch(self):
+        """
+        Removes the next batch to run from the buckets, a full bucket goes first,
+        then the bucket with the oldest expired request
+
+        :returns batch, timeout: the batch or None and the time until the next deadline
+        """
+        now = time.time()
+        expired = None
+        oldest_deadline = None
+        for shape, requests in self._buckets.items():
+            if len(requests) >= self.max_batch_size:
+                expired = shape
+                break
+            # the buckets keep their requests in arrival order
+            deadline = requests[0].arrival + self.max_latency
+            if oldest_deadline is None or deadline < oldest_deadline:
+                oldest_deadline = deadline
+                if deadline <= now:
+                    expired = shape
+
+        if expired is None:
+            return None, None if oldest_deadline is None else oldest_deadline - now
+
+        requests = self._buckets[expired]
+        batch = requests[:self.max_batch_size]
+        if len(requests) > self.max_batch_size:
+            self._buckets[expired] = requests[self.max_batch_size:]
+        else:
+            del self._buckets[expired]
+        self._pending -= len(batch)
+        return batch, None
+
+    def _work(self):
+        while True:
+            with self._condition:
+                batch, timeout = self._take_batch()
+                while batch is None and self._running:
+                    self._condition.wait(timeout)
+                    batch, timeout = self._take_batch()
+                if batch is None:
+                    return
+            self._run(batch)
+
+    def _run(self, batch):
+        try:
+            predictions = self.predict_fn(np.stack([request.image for request in batch]))
+        except Exception as error:
+            for request in batch:
+                request._finish(error=error)
+            return
+
+        now = time.time()
+        with self._condition:
+            self.batch_sizes[len(batch)] += 1
+            self.latencies.extend(now - request.arrival for request in batch)
+        for request, prediction in zip(batch, predictions):
+            request._finish(prediction)
+
+    def queue_depth(self):
+        """
+        Number of queued requests not yet running
+        """
+        with self._condition:
+            return self._pending
+
+    def stats(self):
+        """
+        Statistics of the batcher, latencies in milliseconds
+
+        :returns stats: dict with the 'queue_depth', the number of 'requests', the 'batch_sizes' histogram
+                        and the 'mean', 'p50', 'p90' and 'p99' request latency
+        """
+        with self._condition:
+            latencies = list(self.latencies)
+            stats = {"queue_depth": self._pending,
+                     "requests": self.request_count,
+                     "batch_sizes": dict(self.batch_sizes)}
+        stats.update(util.latency_stats(latencies))
+        return stats
+
+    def stop(self):
+        """
+        Flushes the queued requests and stops the workers
+        """
+        with self._condition:
+            self._running = False
+            # the remaining requests are due immediately
+            self.max_latency = 0
+            self._condition.notify_all()
+        for worker in self._workers:
+            worker.join()
+        self._workers = []
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
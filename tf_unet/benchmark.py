@@ -0,0 +1,204 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Training and inference throughput on synthetic data. Every configuration of
+the parameter matrix runs in a fresh process such that the peak memory is
+measured per configuration. The results are written as JSON together with
+the commit they were measured on. The loss and the Dice on a held-out batch
+after the training steps show the accuracy impact of the precision.
+
+Usage:
+python -m tf_unet.benchmark --sizes 256 512 --layers 3 --features-root 16 32 --n-class 2 --batch-sizes 1 4 --threads 0 4 --precisions float32 bfloat16 --output benchmark.json
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import sys
+import json
+import time
+import platform
+import resource
+import argparse
+import itertools
+import subprocess
+from collections import OrderedDict
+
+import numpy as np
+
+from tf_unet import util
+
+
+def _synthetic_provider(size, n_class):
+    from tf_unet import image_gen
+
+    # the default border and radii of the circles only fit images larger than 184 pixels
+    shapes = dict(border=size // 8, r_max=max(size // 4, 6))
+    if n_class == 2:
+        return image_gen.GrayScaleDataProvider(size, size, **shapes)
+    if n_class == 3:
+        return image_gen.GrayScaleDataProvider(size, size, rectangles=True, **shapes)
+    return image_gen.MarkerDataProvider(size, size, n_class=n_class)
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+def run_config(size, layers, features_root, n_class, batch_size, threads, precision="float32", train_steps=20,
+               inference_batches=20, warmup=3, verification_batch_size=4, seed=1):
+    """
+    Measures a single configuration in the current process
+
+    :param size: edge length of the synthetic images
+    :param layers: number of layers in the net
+    :param features_root: number of features in the first layer
+    :param n_class: number of output labels
+    :param batch_size: number of images per training and inference batch
+    :param threads: intra and inter op threads of the session, 0 lets TensorFlow decide
+    :param precision: (optional) precision of the net, see unet.Unet
+    :param train_steps: (optional) number of timed training steps
+    :param inference_batches: (optional) number of timed inference batches
+    :param warmup: (optional) number of untimed steps before each measurement
+    :param verification_batch_size: (optional) number of held-out images evaluated after the training steps
+
+    :returns result: dict with the configuration, the training steps/sec, the inference images/sec,
+                     the latency percentiles in milliseconds, the verification loss and Dice and the peak RSS in MB
+    """
+    import tensorflow as tf
+    from tf_unet import unet
+    from tf_unet import evaluation
+
+    np.random.seed(seed)
+    provider = _synthetic_provider(size, n_class)
+    batch_x, batch_y = provider(batch_size)
+    veri_x, veri_y = provider(verification_batch_size)
+
+    # the Unet builds a fresh default graph, every configuration runs in its own process
+    net = unet.Unet(channels=provider.channels, n_class=n_class, layers=layers, features_root=features_root,
+                    summaries=False, precision=precision, seed=seed)
+    train_op = tf.train.MomentumOptimizer(learning_rate=0.01, momentum=0.9).minimize(net.cost)
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=threads, inter_op_parallelism_threads=threads)
+    with tf.Session(config=config) as sess:
+        sess.run(tf.global_variables_initializer())
+
+        train_feed = {net.x: batch_x, net.y: batch_y, net.keep_prob: 0.75}
+        for _ in range(warmup):
+            sess.run(train_op, feed_dict=train_feed)
+        train_times = []
+        for _ in range(train_steps):
+            start = time.time()
+            sess.run(train_op, feed_dict=train_feed)
+            train_times.append(time.time() - start)
+
+        inference_feed = {net.x: batch_x, net.keep_prob: 1.}
+        for _ in range(warmup):
+            sess.run(net.predicter, feed_dict=inference_feed)
+        inference_times = []
+        for _ in range(inference_batches):
+            start = time.time()
+            sess.run(net.predicter, feed_dict=inference_feed)
+            inference_times.append(time.time() - start)
+
+        loss, prediction = sess.run((net.cost, net.predicter), feed_dict={net.x: veri_x, net.y: veri_y})
+        confusion = evaluation.confusion_matrix(np.argmax(prediction, 3), np.argmax(veri_y, 3), n_class)
+        dice = evaluation.dice_coefficients(confusion)
+
+    return OrderedDict([("size", size),
+                        ("layers", layers),
+                        ("features_root", features_root),
+                        ("n_class", n_class),
+                        ("batch_size", batch_size),
+                        ("threads", threads),
+                        ("precision", precision),
+                        ("train_steps_per_sec", len(train_times) / sum(train_times)),
+                        ("train_latency", util.latency_stats(train_times)),
+                        ("inference_images_per_sec", batch_size * len(inference_times) / sum(inference_times)),
+                        ("inference_latency", util.latency_stats(inference_times)),
+                        ("verification_loss", float(loss)),
+                        ("verification_dice", [None if np.isnan(value) else float(value) for value in dice]),
+                        ("verification_mean_dice", float(np.nanmean(dice))),
+                        ("peak_rss_mb", _peak_rss_mb())])
+
+
+def _commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "HEAD"]).decode("utf-8").strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(sizes=(256,), layers=(3,), features_root=(16,), n_class=(2,), batch_sizes=(1,), threads=(0,),
+                  precisions=("float32",), **kwargs):
+    """
+    Runs every configuration of the parameter matrix in a separate process
+
+    :param kwargs: (optional) passed to run_config
+
+    :returns report: dict with the commit, the environment and the list of results
+    """
+    import tensorflow as tf
+
+    results = []
+    for config in itertools.product(sizes, layers, features_root, n_class, batch_sizes, threads, precisions):
+        arguments = dict(zip(("size", "layers", "features_root", "n_class", "batch_size", "threads", "precision"),
+                             config))
+        arguments.update(kwargs)
+        output = subprocess.check_output([sys.executable, "-m", "tf_unet.benchmark", "--config", json.dumps(arguments)])
+        result = json.loads(output.decode("utf-8").strip().splitlines()[-1], object_pairs_hook=OrderedDict)
+        print("{:}: {:.2f} train steps/sec, {:.1f} images/sec, mean Dice {:.4f}".format(
+            config, result["train_steps_per_sec"], result["inference_images_per_sec"], result["verification_mean_dice"]))
+        results.append(result)
+
+    return OrderedDict([("commit", _commit()),
+                        ("timestamp", time.strftime("%Y-%m-%dT%H:%M:%S")),
+                        ("python", platform.python_version()),
+                        ("platform", platform.platform()),
+                        ("tensorflow", tf.__version__),
+                        ("numpy", np.__version__),
+                        ("results", results)])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Training and inference benchmark of the unet on synthetic data")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[256])
+    parser.add_argument("--layers", type=int, nargs="+", default=[3])
+    parser.add_argument("--features-root", type=int, nargs="+", default=[16])
+    parser.add_argument("--n-class", type=int, nargs="+", default=[2])
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1])
+    parser.add_argument("--threads", type=int, nargs="+", default=[0])
+    parser.add_argument("--precisions", nargs="+", default=["float32"], choices=["float32", "bfloat16"])
+    parser.add_argument("--train-steps", type=int, default=20)
+    parser.add_argument("--inference-batches", type=int, default=20)
+    parser.add_argument("--warmup", type=int, default=3)
+    parser.add_argument("--output", default="benchmark.json")
+    parser.add_argument("--config", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.config is not None:
+        # a single configuration run by run_benchmark
+        print(json.dumps(run_config(**json.loads(args.config))))
+        return
+
+    report = run_benchmark(args.sizes, args.layers, args.features_root, args.n_class, args.batch_sizes, args.threads,
+                           args.precisions, train_steps=args.train_steps, inference_batches=args.inference_batches, warmup=args.warmup)
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print("Results written to '{:}'".format(args.output))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,237 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Checkpointing during training. The variables are snapshotted in the training
+thread and written to disk from a background thread through a shadow graph,
+such that training continues while the checkpoint is written. Old checkpoints
+are deleted except for the most recent ones and the best ones by a
+verification metric.
+
+Usage:
+manager = CheckpointManager("trained_models/", max_to_keep=3, keep_best=1, metric="mean_dice", save_secs=600)
+manager.maybe_save(sess, step, metrics)
+...
+manager.close()
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import os
+import glob
+import time
+import logging
+import threading
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import tensorflow as tf
+
+
+class CheckpointManager(object):
+    """
+    Saves checkpoints of the variables of the current default graph with a single Saver
+
+    :param output_path: directory the checkpoints are written to
+    :param var_list: (optional) variables to save, all global variables by default
+    :param max_to_keep: (optional) number of most recent checkpoints to keep, all if None
+    :param keep_best: (optional) number of best checkpoints by `metric` kept in addition
+    :param metric: (optional) key of the verification metric ranking the checkpoints, see evaluation.StreamingEvaluator
+    :param mode: (optional) 'max' if larger metric values are better, 'min' otherwise
+    :param save_steps: (optional) minimal number of steps between two checkpoints
+    :param save_secs: (optional) minimal number of seconds between two checkpoints. Both intervals are only
+                      checked when maybe_save is called, i.e. once per epoch by Trainer.train
+    :param async_save: (optional) Flag if the checkpoints should be written from a background thread
+    :param prefix: (optional) file name prefix of the checkpoints
+    """
+
+    def __init__(self, output_path, var_list=None, max_to_keep=5, keep_best=1, metric="mean_dice", mode="max",
+                 save_steps=None, save_secs=None, async_save=True, prefix="model.cpkt"):
+        if mode not in ("max", "min"):
+            raise ValueError("Unknown mode: %s" % mode)
+
+        self.output_path = output_path
+        self.max_to_keep = max_to_keep
+        self.keep_best = keep_best
+        self.metric = metric
+        self.mode = mode
+        self.save_steps = save_steps
+        self.save_secs = save_secs
+        self.async_save = async_save
+        self.prefix = os.path.join(output_path, prefix)
+
+        self.var_list = tf.global_variables() if var_list is None else list(var_list)
+        # (path, step, metric value) of the checkpoints on disk in the order they were written
+        self.checkpoints = []
+        self.last_step = None
+        self.last_time = None
+        self.error = None
+        self._lock = threading.Lock()
+
+        if async_save:
+            self._build_shadow_graph()
+            self._queue = queue.Queue(maxsize=1)
+            self._writer = threading.Thread(target=self._write_loop)
+            self._writer.daemon = True
+            self._writer.start()
+        else:
+            self.saver = tf.train.Saver(self.var_list, max_to_keep=None)
+
+    def _build_shadow_graph(self):
+        """
+        Mirrors the variables in a separate graph, the checkpoints written from it
+        carry the names of the original variables
+        """
+        self._shadow_graph = tf.Graph()
+        with self._shadow_graph.as_default():
+            self._shadow_vars = [tf.Variable(tf.zeros(variable.get_shape(), dtype=variable.dtype.base_dtype),
+                                             trainable=False)
+                                 for variable in self.var_list]
+            self.saver = tf.train.Saver(dict((variable.op.name, shadow)
+                                             for variable, shadow in zip(self.var_list, self._shadow_vars)),
+                                        max_to_keep=None)
+            init = tf.variables_initializer(self._shadow_vars)
+        self._shadow_sess = tf.Session(graph=self._shadow_graph)
+        self._shadow_sess.run(init)
+
+    def should_save(self, step):
+        """
+        Flag if a checkpoint is due at the given step. A checkpoint is always due if no interval is set
+        """
+        if self.last_step is None or (self.save_steps is None and self.save_secs is None):
+            return True
+        if self.save_steps is not None and step - self.last_step >= self.save_steps:
+            return True
+        if self.save_secs is not None and time.time() - self.last_time >= self.save_secs:
+            return True
+        return False
+
+    def maybe_save(self, sess, step, metrics=None):
+        """
+        Saves a checkpoint if one is due, see should_save. Trainer.train calls it at the end of every epoch
+        with the verification metrics, hence shorter intervals are rounded up to whole epochs
+
+        :returns path: the checkpoint path or None if no checkpoint was due
+        """
+        if not self.should_save(step):
+            return None
+        return self.save(sess, step, metrics)
+
+    def save(self, sess, step, metrics=None):
+        """
+        Saves a checkpoint. Asynchronously only the variable values are fetched,
+        the call blocks while the previous checkpoint is still being written
+
+        :param sess: current session
+        :param step: global step the checkpoint is named after
+        :param metrics: (optional) dict of verification metrics ranking the checkpoint
+
+        :returns path: the checkpoint path
+        """
+        if self.error is not None:
+            raise self.error
+
+        path = "%s-%s" % (self.prefix, step)
+        value = None if metrics is None or self.metric not in metrics else float(metrics[self.metric])
+        self.last_step = step
+        self.last_time = time.time()
+
+        if self.async_save:
+            self._queue.put((sess.run(self.var_list), path, step, value))
+        else:
+            self.saver.save(sess, path, write_meta_graph=False, write_state=False)
+            self._retain(path, step, value)
+        return path
+
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                self._queue.task_done()
+                return
+            values, path, step, value = item
+            try:
+                for shadow, variable_value in zip(self._shadow_vars, values):
+                    shadow.load(variable_value, self._shadow_sess)
+                self.saver.save(self._shadow_sess, path, write_meta_graph=False, write_state=False)
+                self._retain(path, step, value)
+            except Exception as error:
+                logging.exception("Writing checkpoint '{:}' failed".format(path))
+                self.error = error
+            finally:
+                self._queue.task_done()
+
+    def _retain(self, path, step, value):
+        """
+        Records the written checkpoint, deletes the ones neither recent nor best
+        and updates the checkpoint state file
+        """
+        with self._lock:
+            self.checkpoints.append((path, step, value))
+
+            recent = self.checkpoints if not self.max_to_keep else self.checkpoints[-self.max_to_keep:]
+            keep = set(checkpoint[0] for checkpoint in recent)
+            ranked = [checkpoint for checkpoint in self.checkpoints if checkpoint[2] is not None]
+            ranked.sort(key=lambda checkpoint: checkpoint[2], reverse=self.mode == "max")
+            keep.update(checkpoint[0] for checkpoint in ranked[:self.keep_best])
+
+            removed = [checkpoint[0] for checkpoint in self.checkpoints if checkpoint[0] not in keep]
+            self.checkpoints = [checkpoint for checkpoint in self.checkpoints if checkpoint[0] in keep]
+            kept = [checkpoint[0] for checkpoint in self.checkpoints]
+
+        for old_path in removed:
+            for filename in glob.glob(old_path + ".*"):
+                os.remove(filename)
+        tf.train.update_checkpoint_state(self.output_path, path, all_model_checkpoint_paths=kept)
+        logging.info("Model saved in file: {:}".format(path))
+
+    def best_checkpoint(self):
+        """
+        Path of the best checkpoint by `metric` written so far or None
+        """
+        with self._lock:
+            ranked = [checkpoint for checkpoint in self.checkpoints if checkpoint[2] is not None]
+        if not ranked:
+            return None
+        best = max if self.mode == "max" else min
+        return best(ranked, key=lambda checkpoint: checkpoint[2])[0]
+
+    def wait(self):
+        """
+        Blocks until the pending checkpoints are written
+        """
+        if self.async_save:
+            self._queue.join()
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        """
+        Writes the pending checkpoints and stops the writer
+        """
+        if self.async_save and self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+            self._shadow_sess.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,247 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Dataset access for the marker training data. The per-sample .mat files of a
+`Data_path` directory can be packed once into a contiguous memory-mapped store
+which is then indexed without opening or decoding any file.
+
+Usage:
+python -m tf_unet.data_store Data_path/ Packed_path/ --train-num 5760 --veri-num 504
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import os
+import json
+import logging
+import argparse
+
+import numpy as np
+import scipy.io as sio
+
+from tf_unet import util
+
+IMAGE_KEY = "Marker_image_%s_augment"
+LABEL_KEY = "Marker_label_%s_multipleclass_augment"
+
+INDEX_FILE = "%s_index.npy"
+IMAGE_FILE = "%s_images.bin"
+LABEL_FILE = "%s_labels.bin"
+META_FILE = "%s_meta.json"
+
+
+def _with_channels(array):
+    """
+    Adds a trailing channel axis to 2d arrays
+    """
+    return array[..., np.newaxis] if array.ndim == 2 else array
+
+
+class MatDataset(object):
+    """
+    Indexes the per-sample .mat files of a data directory, e.g.
+    'Marker_image_train_augment_1.mat' and 'Marker_label_train_multipleclass_augment_1.mat'.
+    Every access opens and decodes both files.
+
+    :param data_path: directory containing the .mat files
+    :param split: name of the split, 'train' or 'verification'
+    :param count: number of samples in the split
+    """
+
+    def __init__(self, data_path, split, count):
+        self.data_path = data_path
+        self.split = split
+        self.count = count
+        self.image_key = IMAGE_KEY % split
+        self.label_key = LABEL_KEY % split
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, idx):
+        """
+        Loads the sample with the given zero based index
+
+        :returns image, label: arrays of shape [nx, ny, channels] and [nx, ny, n_class]
+        """
+        if idx < 0 or idx >= self.count:
+            raise IndexError("Sample index out of range: %s" % idx)
+
+        # the files on disk are numbered from 1
+        image = sio.loadmat(os.path.join(self.data_path, "%s_%s.mat" % (self.image_key, idx + 1)))[self.image_key]
+        label = sio.loadmat(os.path.join(self.data_path, "%s_%s.mat" % (self.label_key, idx + 1)))[self.label_key]
+        return _with_channels(image), _with_channels(label)
+
+
+class PackedDataset(object):
+    """
+    Reads a split packed with `pack_dataset`. Samples are returned as read-only
+    views into the memory-mapped store, hence no copy is made until the caller
+    writes into a batch. Labels packed as class index are returned as [nx, ny] uint8 maps.
+
+    :param path: directory of the packed store
+    :param split: name of the split, 'train' or 'verification'
+    """
+
+    def __init__(self, path, split):
+        self.path = path
+        self.split = split
+
+        with open(os.path.join(path, META_FILE % split)) as f:
+            meta = json.load(f)
+        self.image_dtype = np.dtype(str(meta["image_dtype"]))
+        self.label_dtype = np.dtype(str(meta["label_dtype"]))
+        self.label_format = meta.get("label_format", "one_hot")
+        self.index = np.load(os.path.join(path, INDEX_FILE % split))
+
+        self._images = None
+        self._labels = None
+
+    def _open(self):
+        # opened lazily such that the dataset can be pickled into worker processes
+        self._images = np.memmap(os.path.join(self.path, IMAGE_FILE % self.split), dtype=self.image_dtype, mode="r")
+        self._labels = np.memmap(os.path.join(self.path, LABEL_FILE % self.split), dtype=self.label_dtype, mode="r")
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        state["_labels"] = None
+        return state
+
+    def __len__(self):
+        return len(self.index)
+
+    def __getitem__(self, idx):
+        """
+        Returns the sample with the given zero based index
+
+        :returns image, label: arrays of shape [nx, ny, channels] and [nx, ny, n_class]
+        """
+        if self._images is None:
+            self._open()
+
+        image_offset, nx, ny, channels, label_offset, lx, ly, n_class = self.index[idx]
+        image = self._images[image_offset:image_offset + nx * ny * channels].reshape(nx, ny, channels)
+        label = self._labels[label_offset:label_offset + lx * ly * n_class]
+        if self.label_format == "index":
+            return image, label.reshape(lx, ly)
+        return image, label.reshape(lx, ly, n_class)
+
+
+def is_packed(path, split):
+    """
+    Checks if the given directory contains a complete packed store of the split. The meta data is
+    written last by `pack_dataset`, hence an interrupted pack is not taken for a store
+    """
+    return os.path.exists(os.path.join(path, META_FILE % split))
+
+
+def open_dataset(data_path, split, count):
+    """
+    Opens the split of the given data directory, preferring a packed store over the .mat files
+
+    :param data_path: directory containing either the packed store or the .mat files
+    :param split: name of the split, 'train' or 'verification'
+    :param count: number of samples in the split. Only used for the .mat files
+    """
+    if is_packed(data_path, split):
+        return PackedDataset(data_path, split)
+    return MatDataset(data_path, split, count)
+
+
+def pack_dataset(dataset, output_path, split, image_dtype=np.float32, label_format="one_hot"):
+    """
+    Writes the samples of the dataset into a contiguous memory-mappable store
+    with an offset index. Samples may differ in shape. The labels are either
+    stored as float32 one-hot stacks or as uint8 class index maps, which
+    take 4*n_class times less space.
+
+    :param dataset: indexable dataset, e.g. `MatDataset`
+    :param output_path: directory of the packed store
+    :param split: name of the split, 'train' or 'verification'
+    :param image_dtype: (optional) dtype used to store the images
+    :param label_format: (optional) 'one_hot' or 'index'
+
+    :returns dataset: the packed dataset
+    """
+    if label_format not in ("one_hot", "index"):
+        raise ValueError("Unknown label format: %s" % label_format)
+
+    if not os.path.exists(output_path):
+        os.makedirs(output_path)
+
+    label_dtype = np.uint8 if label_format == "index" else np.float32
+    index = np.zeros((len(dataset), 8), dtype=np.int64)
+    image_offset = 0
+    label_offset = 0
+    with open(os.path.join(output_path, IMAGE_FILE % split), "wb") as image_file, \
+         open(os.path.join(output_path, LABEL_FILE % split), "wb") as label_file:
+        for idx in range(len(dataset)):
+            image, label = dataset[idx]
+            image = np.ascontiguousarray(image, dtype=image_dtype)
+            if label_format == "index":
+                label = util.to_class_index(label)[..., np.newaxis]
+            label = np.ascontiguousarray(label, dtype=label_dtype)
+
+            index[idx] = (image_offset,) + image.shape + (label_offset,) + label.shape
+            image.tofile(image_file)
+            label.tofile(label_file)
+            image_offset += image.size
+            label_offset += label.size
+
+            if (idx + 1) % 500 == 0:
+                logging.info("Packed {:} of {:} '{:}' samples".format(idx + 1, len(dataset), split))
+
+    np.save(os.path.join(output_path, INDEX_FILE % split), index)
+    # the meta data is written last, an interrupted run leaves no valid store behind
+    with open(os.path.join(output_path, META_FILE % split), "w") as f:
+        json.dump({"image_dtype": np.dtype(image_dtype).name,
+                   "label_dtype": np.dtype(label_dtype).name,
+                   "label_format": label_format,
+                   "count": len(dataset)}, f)
+
+    logging.info("Packed {:} '{:}' samples into '{:}'".format(len(dataset), split, output_path))
+    return PackedDataset(output_path, split)
+
+
+def pack_mat_directory(data_path, output_path, train_num, veri_num, label_format="one_hot"):
+    """
+    Packs the training and verification .mat files of a data directory
+
+    :param data_path: directory containing the .mat files
+    :param output_path: directory of the packed store
+    :param train_num: number of training samples
+    :param veri_num: number of verification samples
+    :param label_format: (optional) 'one_hot' or 'index'
+    """
+    pack_dataset(MatDataset(data_path, "train", train_num), output_path, "train", label_format=label_format)
+    pack_dataset(MatDataset(data_path, "verification", veri_num), output_path, "verification", label_format=label_format)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Packs a directory of marker .mat files into a memory-mapped store")
+    parser.add_argument("data_path", help="directory containing the .mat files")
+    parser.add_argument("output_path", help="directory of the packed store")
+    parser.add_argument("--train-num", type=int, required=True, help="number of training samples")
+    parser.add_argument("--veri-num", type=int, required=True, help="number of verification samples")
+    parser.add_argument("--label-format", default="one_hot", choices=("one_hot", "index"),
+                        help="store the labels as one-hot stacks or as uint8 class index maps")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
+    pack_mat_directory(args.data_path, args.output_path, args.train_num, args.veri_num, args.label_format)
+
+
+if __name__ == "__main__":
+    main()
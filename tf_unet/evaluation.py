@@ -0,0 +1,148 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Streaming evaluation of a whole verification set. Every batch runs through a
+single forward pass, only the per batch confusion matrix and loss sums are
+fetched and accumulated, hence the memory does not grow with the set size.
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import numpy as np
+
+from tf_unet import util
+
+
+def confusion_matrix(prediction, labels, n_class):
+    """
+    Computes the confusion matrix of dense class index maps, use `np.argmax(..., axis=-1)`
+    to convert class probabilities or one-hot labels
+
+    :param prediction: predicted class index map
+    :param labels: true class index map
+    :param n_class: number of classes
+
+    :returns confusion: matrix of shape [n_class, n_class], rows are the true and columns the predicted classes
+    """
+    flat = labels.astype(np.int64).ravel() * n_class + prediction.astype(np.int64).ravel()
+    return np.bincount(flat, minlength=n_class * n_class).reshape(n_class, n_class)
+
+
+def dice_coefficients(confusion):
+    """
+    Per class Dice coefficient 2TP / (2TP + FP + FN). Classes which neither occur
+    nor are predicted are NaN
+    """
+    tp = np.diag(confusion).astype(np.float64)
+    denominator = confusion.sum(axis=0) + confusion.sum(axis=1)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(denominator > 0, 2 * tp / denominator, np.nan)
+
+
+def iou_scores(confusion):
+    """
+    Per class intersection over union TP / (TP + FP + FN). Classes which neither
+    occur nor are predicted are NaN
+    """
+    tp = np.diag(confusion).astype(np.float64)
+    union = confusion.sum(axis=0) + confusion.sum(axis=1) - tp
+    with np.errstate(divide="ignore", invalid="ignore"):
+        return np.where(union > 0, tp / union, np.nan)
+
+
+class StreamingEvaluator(object):
+    """
+    Evaluates a net on a whole dataset in batches and accumulates a confusion
+    matrix, the loss and the per class cross entropy.
+
+    :param net: the unet instance to evaluate
+    :param batch_size: (optional) number of samples per forward pass
+    """
+
+    def __init__(self, net, batch_size=4):
+        self.net = net
+        self.batch_size = batch_size
+        self.reset()
+
+    def reset(self):
+        self.confusion = np.zeros((self.net.n_class, self.net.n_class), dtype=np.int64)
+        self.class_cross_entropy = np.zeros(self.net.n_class)
+        self.loss_sum = 0.0
+        self.sample_count = 0
+
+    def update(self, sess, batch_x, batch_y, return_prediction=False):
+        """
+        Runs one batch through the net and accumulates its statistics
+
+        :param return_prediction: (optional) Flag if the class probabilities should be fetched as well
+
+        :returns prediction: the class probabilities of the batch or None
+        """
+        batch_y = util.crop_to_shape(batch_y, self.net.prediction_shape(sess, batch_x.shape))
+        fetches = [self.net.cost, self.net.confusion_matrix, self.net.class_cross_entropy]
+        if return_prediction:
+            fetches.append(self.net.predicter)
+
+        results = sess.run(fetches, feed_dict={self.net.x: batch_x,
+                                               self.net.y: batch_y,
+                                               self.net.keep_prob: 1.})
+        loss, confusion, class_cross_entropy = results[:3]
+        self.confusion += confusion
+        self.class_cross_entropy += class_cross_entropy
+        self.loss_sum += loss * len(batch_x)
+        self.sample_count += len(batch_x)
+        return results[3] if return_prediction else None
+
+    def evaluate(self, sess, source, num_batches=1):
+        """
+        Evaluates the whole dataset
+
+        :param sess: current session
+        :param source: indexable dataset (see data_store) or callable data provider (see image_util)
+        :param num_batches: (optional) number of batches drawn from a data provider
+
+        :returns metrics: see `metrics`
+        """
+        self.reset()
+        if callable(source):
+            for _ in range(num_batches):
+                self.update(sess, *source(self.batch_size))
+            return self.metrics()
+
+        for start in range(0, len(source), self.batch_size):
+            samples = [source[idx] for idx in range(start, min(start + self.batch_size, len(source)))]
+            self.update(sess, np.stack([image for image, _ in samples]), np.stack([label for _, label in samples]))
+
+        return self.metrics()
+
+    def metrics(self):
+        """
+        Computes the metrics of the accumulated statistics
+
+        :returns metrics: dict with the mean 'loss', pixel 'accuracy', per class 'dice', 'iou'
+                          and 'cross_entropy' as well as the 'mean_dice' and 'mean_iou' of all classes
+        """
+        dice = dice_coefficients(self.confusion)
+        iou = iou_scores(self.confusion)
+        class_pixels = self.confusion.sum(axis=1)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            class_cross_entropy = np.where(class_pixels > 0, self.class_cross_entropy / class_pixels, np.nan)
+
+        return {"loss": self.loss_sum / max(self.sample_count, 1),
+                "accuracy": np.trace(self.confusion) / max(self.confusion.sum(), 1),
+                "dice": dice,
+                "iou": iou,
+                "cross_entropy": class_cross_entropy,
+                "mean_dice": np.nanmean(dice),
+                "mean_iou": np.nanmean(iou)}
@@ -0,0 +1,111 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Export of a trained net as frozen, inference-only graph. The net is rebuilt
+without dropout, cost, gradients and summaries, the variables are folded into
+constants. The graph is loaded with predictor.load_frozen_graph or
+predictor.Predictor.from_frozen_graph.
+
+Usage:
+python -m tf_unet.export TrainedModels/ unet_frozen.pb --channels 1 --n-class 6 --layers 3 --features-root 64
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import logging
+import argparse
+
+import tensorflow as tf
+from tensorflow.tools.graph_transforms import TransformGraph
+
+from tf_unet import unet
+from tf_unet import predictor
+from tf_unet.layers import pixel_wise_softmax_2
+
+INPUT_NAME = "x"
+OUTPUT_NAME = "prediction"
+
+TRANSFORMS = ["strip_unused_nodes",
+              "remove_nodes(op=Identity, op=CheckNumerics)",
+              "fold_constants(ignore_errors=true)",
+              "sort_by_execution_order"]
+
+
+def build_inference_graph(channels, n_class, **kwargs):
+    """
+    Builds the net without dropout and training ops in a new graph
+
+    :param channels: number of channels in the input image
+    :param n_class: number of output labels
+    :param kwargs: (optional) net parameters passed to unet.create_conv_net
+
+    :returns graph, x, prediction: the graph with its input and output tensors
+    """
+    kwargs["summaries"] = False
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, shape=[None, None, None, channels], name=INPUT_NAME)
+        # the variables are created in the same order as in the Unet, hence the checkpoint names match
+        logits, _, _ = unet.create_conv_net(x, None, channels, n_class, **kwargs)
+        prediction = tf.identity(pixel_wise_softmax_2(logits), name=OUTPUT_NAME)
+    return graph, x, prediction
+
+
+def export_inference_graph(model_path, output_file, channels, n_class, **kwargs):
+    """
+    Freezes a trained checkpoint into a constant folded inference graph
+
+    :param model_path: checkpoint directory or prefix
+    :param output_file: path of the frozen graph protobuf
+    :param channels: number of channels in the input image
+    :param n_class: number of output labels
+    :param kwargs: (optional) net parameters passed to unet.create_conv_net, e.g. layers and features_root
+
+    :returns graph_def: the frozen graph
+    """
+    graph, _, _ = build_inference_graph(channels, n_class, **kwargs)
+    with graph.as_default():
+        saver = tf.train.Saver()
+
+    with tf.Session(graph=graph) as sess:
+        saver.restore(sess, predictor.resolve_checkpoint(model_path))
+        graph_def = tf.graph_util.convert_variables_to_constants(sess, graph.as_graph_def(), [OUTPUT_NAME])
+
+    graph_def = TransformGraph(graph_def, [INPUT_NAME], [OUTPUT_NAME], TRANSFORMS)
+
+    with tf.gfile.GFile(output_file, "wb") as f:
+        f.write(graph_def.SerializeToString())
+    logging.info("Frozen graph with {:} nodes written to '{:}'".format(len(graph_def.node), output_file))
+    return graph_def
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Exports a trained unet checkpoint as frozen inference graph")
+    parser.add_argument("model_path", help="checkpoint directory or prefix")
+    parser.add_argument("output_file", help="path of the frozen graph protobuf")
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--n-class", type=int, default=6)
+    parser.add_argument("--layers", type=int, default=3)
+    parser.add_argument("--features-root", type=int, default=64)
+    parser.add_argument("--filter-size", type=int, default=3)
+    parser.add_argument("--pool-size", type=int, default=2)
+    args = parser.parse_args()
+
+    export_inference_graph(args.model_path, args.output_file, args.channels, args.n_class,
+                           layers=args.layers, features_root=args.features_root,
+                           filter_size=args.filter_size, pool_size=args.pool_size)
+
+
+if __name__ == "__main__":
+    main()
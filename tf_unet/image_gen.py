@@ -22,6 +22,7 @@ author: jakeret
 from __future__ import print_function, division, absolute_import, unicode_literals
 
 import numpy as np
+from tf_unet import util
 from tf_unet.image_util import BaseDataProvider
 
 class GrayScaleDataProvider(BaseDataProvider):
@@ -58,6 +59,91 @@ class RgbDataProvider(BaseDataProvider):
         data, label = create_image_and_label(self.nx, self.ny, **self.kwargs)
         return to_rgb(data), label
 
+class MarkerDataProvider(BaseDataProvider):
+    """
+    Synthetic stand-in for the multiple-class marker segmentation. Whole batches
+    of small, class-imbalanced markers are rendered at once, see create_marker_batch
+
+    :param nx: image size in x
+    :param ny: image size in y
+    :param n_class: (optional) number of classes including the background
+    :param kwargs: (optional) passed to create_marker_batch
+    """
+    channels = 1
+    n_class = 6
+    
+    def __init__(self, nx, ny, n_class=6, **kwargs):
+        super(MarkerDataProvider, self).__init__()
+        self.nx = nx
+        self.ny = ny
+        self.n_class = n_class
+        self.kwargs = kwargs
+    
+    def _next_data(self):
+        images, labels = create_marker_batch(1, self.nx, self.ny, self.n_class, **self.kwargs)
+        return images[0], util.to_one_hot(labels[0], self.n_class)
+    
+    def __call__(self, n, out=None):
+        # the batch is rendered at once into new arrays, `out` is not used
+        X, Y = create_marker_batch(n, self.nx, self.ny, self.n_class, **self.kwargs)
+        if self.label_format != "index":
+            Y = util.to_one_hot(Y, self.n_class)
+        if self.augmenter is not None:
+            X, Y = self.augmenter(X, Y)
+        return X, Y
+
+def create_marker_batch(n, nx, ny, n_class=6, cnt=12, r_min=3, r_max=10, border=None, class_probs=None,
+                        background=0.1, sigma=0.1):
+    """
+    Renders a batch of images with small markers of n_class-1 types on a noisy background.
+    Odd classes are discs and even classes squares of increasing intensity, every pixel
+    belongs to the nearest marker covering it. All markers of the batch are rendered in
+    one distance field of n*cnt*nx*ny float32 values
+    
+    :param n: number of images
+    :param nx: image size in x
+    :param ny: image size in y
+    :param n_class: (optional) number of classes including the background
+    :param cnt: (optional) number of markers per image
+    :param r_min: (optional) minimal marker radius
+    :param r_max: (optional) maximal marker radius
+    :param border: (optional) minimal distance of the marker centers to the image border, r_max by default
+    :param class_probs: (optional) probabilities of the marker classes 1..n_class-1, decaying as 1/class by default
+    :param background: (optional) intensity of the background
+    :param sigma: (optional) standard deviation of the gaussian noise
+    
+    :returns images, labels: float32 images in [0, 1] of shape [n, nx, ny, 1] and uint8 class indices [n, nx, ny]
+    """
+    if class_probs is None:
+        class_probs = 1. / np.arange(1, n_class)
+    class_probs = np.asarray(class_probs, dtype=np.float64) / np.sum(class_probs)
+    border = r_max if border is None else border
+    
+    centers_x = np.random.uniform(border, nx - border, (n, cnt, 1, 1)).astype(np.float32)
+    centers_y = np.random.uniform(border, ny - border, (n, cnt, 1, 1)).astype(np.float32)
+    radii = np.random.uniform(r_min, r_max, (n, cnt, 1, 1)).astype(np.float32)
+    classes = np.random.choice(np.arange(1, n_class), size=(n, cnt), p=class_probs).astype(np.uint8)
+    intensities = (0.3 + 0.7 * classes / (n_class - 1) + np.random.uniform(-0.05, 0.05, (n, cnt))).astype(np.float32)
+    
+    # distances to the marker centers relative to the radius, euclidean for discs and chebyshev for squares
+    dx = np.abs(np.arange(nx, dtype=np.float32).reshape(1, 1, nx, 1) - centers_x)
+    dy = np.abs(np.arange(ny, dtype=np.float32).reshape(1, 1, 1, ny) - centers_y)
+    square = (classes % 2 == 0)[..., np.newaxis, np.newaxis]
+    distance = np.where(square, np.maximum(dx, dy), np.sqrt(dx * dx + dy * dy))
+    distance /= radii
+    
+    nearest = np.argmin(distance, axis=1)
+    inside = np.min(distance, axis=1) <= 1
+    batch_idx = np.arange(n).reshape(n, 1, 1)
+    
+    labels = np.where(inside, classes[batch_idx, nearest], 0).astype(np.uint8)
+    images = np.where(inside, intensities[batch_idx, nearest], np.float32(background))
+    images += np.random.normal(scale=sigma, size=images.shape).astype(np.float32)
+    
+    images -= np.amin(images, axis=(1, 2), keepdims=True)
+    images /= np.maximum(np.amax(images, axis=(1, 2), keepdims=True), np.finfo(np.float32).eps)
+    return images[..., np.newaxis], labels
+
 def create_image_and_label(nx,ny, cnt = 10, r_min = 5, r_max = 50, border = 92, sigma = 20, rectangles=False):
     
     
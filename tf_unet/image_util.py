@@ -18,9 +18,13 @@ from __future__ import print_function, division, absolute_import, unicode_litera
 
 #import cv2
 import glob
+import threading
+from multiprocessing.pool import ThreadPool
 import numpy as np
 from PIL import Image
 
+from tf_unet import util
+
 class BaseDataProvider(object):
     """
     Abstract base class for DataProvider implementation. Subclasses have to
@@ -28,20 +32,44 @@ class BaseDataProvider(object):
     This implementation automatically clips the data with the given min/max and
     normalizes the values to (0,1]. To change this behavoir the `_process_data`
     method can be overwritten. To enable some post processing such as data
-    augmentation the `_post_process` method can be overwritten.
+    augmentation the `_post_process` method can be overwritten or a batch
+    augmenter (see augment.BatchAugmenter) can be assigned to `augmenter`.
+
+    Setting `label_format` to 'index' makes the provider return compact uint8
+    class index maps of shape [n, nx, ny] instead of one-hot labels.
+
+    The samples of a batch are loaded by a pool of `num_threads` threads into
+    float32 arrays, `_next_data` has to be thread safe (see `_lock`).
 
     :param a_min: (optional) min value used for clipping
     :param a_max: (optional) max value used for clipping
+    :param num_threads: (optional) number of threads loading the samples of a batch
 
     """
     
     channels = 1
     n_class = 2
+    augmenter = None
+    label_format = "one_hot"
     
 
-    def __init__(self, a_min=None, a_max=None):
+    def __init__(self, a_min=None, a_max=None, num_threads=4):
         self.a_min = a_min if a_min is not None else -np.inf
         self.a_max = a_max if a_min is not None else np.inf
+        self.num_threads = num_threads
+        self._lock = threading.Lock()
+        self._pool = None
+    
+    def __getstate__(self):
+        # the lock and the pool are recreated in the worker processes of the loader
+        state = self.__dict__.copy()
+        state["_lock"] = None
+        state["_pool"] = None
+        return state
+    
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
 
     def _load_data_and_label(self):
         data, label = self._next_data()
@@ -54,9 +82,16 @@ class BaseDataProvider(object):
         nx = data.shape[1]
         ny = data.shape[0]
 
+        if self.label_format == "index":
+            return train_data.reshape(1, ny, nx, self.channels), labels.reshape(1, ny, nx),
         return train_data.reshape(1, ny, nx, self.channels), labels.reshape(1, ny, nx, self.n_class),
     
     def _process_labels(self, label):
+        if self.label_format == "index":
+            if self.n_class == 2 and label.ndim == 2:
+                return label.astype(np.uint8)
+            return util.to_class_index(label)
+        
         if self.n_class == 2:
             nx = label.shape[1]
             ny = label.shape[0]
@@ -71,15 +106,18 @@ class BaseDataProvider(object):
         return label
     
     def _process_data(self, data):
-        # normalization
-        data = np.clip(np.fabs(data), self.a_min, self.a_max)
+        # normalization, in place unless the data is a view or not float32
+        if data.dtype != np.float32 or data.base is not None:
+            data = data.astype(np.float32)
+        np.fabs(data, out=data)
+        if np.isfinite(self.a_min) or np.isfinite(self.a_max):
+            np.clip(data, self.a_min, self.a_max, out=data)
         data -= np.amin(data)
         # data /= np.amax(data)
         # By XY
-        if np.amax(data) == 0:
-            data /= 1
-        else:
-            data /= np.amax(data)
+        data_max = np.amax(data)
+        if data_max != 0:
+            data /= data_max
         # By XY
         return data
     
@@ -90,25 +128,67 @@ class BaseDataProvider(object):
         :param data: the data array
         :param labels: the label array
         """
-        return data, labels
+        if self.augmenter is None:
+            return data, labels
+        
+        ny, nx = labels.shape[:2]
+        # index labels have to stay [n, nx, ny], the augmenter would treat a trailing axis as one-hot classes
+        if self.label_format == "index":
+            batch_y = labels.reshape(1, ny, nx)
+        else:
+            batch_y = labels.reshape(1, ny, nx, -1)
+        batch_x, batch_y = self.augmenter(data.reshape(1, ny, nx, -1), batch_y)
+        return batch_x.reshape(data.shape), batch_y.reshape(labels.shape)
     
-    def __call__(self, n):
+    def __call__(self, n, out=None):
+        """
+        Loads a batch of n samples
+        
+        :param n: number of samples
+        :param out: (optional) tuple of preallocated arrays `(X, Y)` filled if their shapes match
+        
+        :returns X, Y: float32 data [n, nx, ny, channels] and labels [n, nx, ny, n_class], uint8 [n, nx, ny] for index labels
+        """
         train_data, labels = self._load_data_and_label()
         nx = train_data.shape[1]
         ny = train_data.shape[2]
     
-        X = np.zeros((n, nx, ny, self.channels))
-        Y = np.zeros((n, nx, ny, self.n_class))
+        if out is None or out[0].shape != (n, nx, ny, self.channels) or out[1].shape != (n,) + labels.shape[1:]:
+            out = (np.empty((n, nx, ny, self.channels), dtype=np.float32),
+                   np.empty((n,) + labels.shape[1:], dtype=np.uint8 if self.label_format == "index" else np.float32))
+        X, Y = out
     
         X[0] = train_data
         Y[0] = labels
-        for i in range(1, n):
-            train_data, labels = self._load_data_and_label()
-            X[i] = train_data
-            Y[i] = labels
+        
+        def load(i):
+            X[i], Y[i] = self._load_data_and_label()
+        
+        if self.num_threads > 1 and n > 2:
+            self._get_pool().map(load, range(1, n))
+        else:
+            for i in range(1, n):
+                load(i)
     
         return X, Y
     
+    def _get_pool(self):
+        # the provider may be called from several loader threads at once
+        with self._lock:
+            if self._pool is None:
+                self._pool = ThreadPool(self.num_threads)
+            return self._pool
+    
+    def close(self):
+        """
+        Stops the loading threads, they are restarted by the next call
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.close()
+            pool.join()
+    
 class SimpleDataProvider(BaseDataProvider):
     """
     A simple data provider for numpy arrays. 
@@ -195,8 +275,10 @@ class ImageDataProvider(BaseDataProvider):
                 np.random.shuffle(self.data_files)
         
     def _next_data(self):
-        self._cylce_file()
-        image_name = self.data_files[self.file_idx]
+        # the loading threads share the position in the file list
+        with self._lock:
+            self._cylce_file()
+            image_name = self.data_files[self.file_idx]
         label_name = image_name.replace(self.data_suffix, self.mask_suffix)
         
         img = self._load_file(image_name, np.float32)
@@ -0,0 +1,74 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+In-graph input pipelines based on tf.data. A Unet built on such a pipeline
+reads its batches from an iterator instead of the feed_dict.
+
+Usage:
+train_data = data_store.open_dataset(Data_path, "train", Train_num)
+net = unet.Unet(channels=1, n_class=6, input_fn=lambda: input_pipeline.make_dataset(train_data, batch_size=4))
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import numpy as np
+import tensorflow as tf
+
+
+def make_dataset(source, batch_size=1, shuffle_buffer=None, num_parallel_calls=4, cache=False, prefetch=2, repeat=True):
+    """
+    Creates a tf.data.Dataset yielding `(batch_x, batch_y)` from an indexable dataset.
+    Class index labels are passed on as uint8 and expanded in the graph.
+    Has to be called inside the graph the network is built in, e.g. through the
+    `input_fn` of the Unet.
+
+    :param source: indexable dataset (see data_store)
+    :param batch_size: (optional) number of samples per batch
+    :param shuffle_buffer: (optional) size of the shuffle buffer, defaults to the whole dataset
+    :param num_parallel_calls: (optional) number of samples loaded in parallel
+    :param cache: (optional) Flag if the loaded samples should be cached in memory
+    :param prefetch: (optional) number of batches prepared ahead
+    :param repeat: (optional) Flag if the dataset should be repeated indefinitely
+    """
+    image, label = source[0]
+    channels = image.shape[-1]
+    label_shape = [None, None] if label.ndim == 2 else [None, None, label.shape[-1]]
+    label_dtype = np.uint8 if label.ndim == 2 else np.float32
+    shuffle_buffer = shuffle_buffer or len(source)
+
+    def load(idx):
+        image, label = source[idx]
+        return image.astype(np.float32), label.astype(label_dtype)
+
+    def load_op(idx):
+        image, label = tf.py_func(load, [idx], [tf.float32, tf.as_dtype(label_dtype)], stateful=False)
+        image.set_shape([None, None, channels])
+        label.set_shape(label_shape)
+        return image, label
+
+    dataset = tf.data.Dataset.range(len(source))
+    if cache:
+        # decode every sample once, shuffling happens on the cached samples
+        dataset = dataset.map(load_op, num_parallel_calls=num_parallel_calls).cache()
+        dataset = dataset.shuffle(shuffle_buffer)
+        if repeat:
+            dataset = dataset.repeat()
+    else:
+        # shuffling the indices is cheap, only the drawn samples are loaded
+        dataset = dataset.shuffle(shuffle_buffer)
+        if repeat:
+            dataset = dataset.repeat()
+        dataset = dataset.map(load_op, num_parallel_calls=num_parallel_calls)
+
+    return dataset.batch(batch_size).prefetch(prefetch)
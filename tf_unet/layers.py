@@ -32,12 +32,45 @@ def bias_variable(shape):
     initial = tf.constant(0.1, shape=shape)
     return tf.Variable(initial)
 
-def conv2d(x, W,keep_prob_):
+def conv2d(x, W,keep_prob_, seed=None):
     # conv_2d = tf.nn.conv2d(x, W, strides=[1, 1, 1, 1], padding='VALID')
     # By XY
     conv_2d = tf.nn.conv2d(x, W, strides=[1, 1, 1, 1], padding='SAME')
     # By XY
-    return tf.nn.dropout(conv_2d, keep_prob_)
+    if keep_prob_ is None:
+        # inference only graph without dropout
+        return conv_2d
+    return dropout(conv_2d, keep_prob_, seed)
+
+def dropout(x, keep_prob, seed=None):
+    """
+    Dropout with a float32 keep probability. If a seed tensor of shape [2] is given the
+    mask is a function of it, such that recomputing it within the same step reproduces
+    the mask. Reduced precision activations are scaled by the mask cast to their dtype
+    """
+    if seed is None and x.dtype == tf.float32:
+        return tf.nn.dropout(x, keep_prob)
+    if seed is None:
+        random_tensor = keep_prob + tf.random_uniform(tf.shape(x))
+    else:
+        random_tensor = keep_prob + tf.contrib.stateless.stateless_random_uniform(tf.shape(x), seed)
+    return x * tf.cast(tf.floor(random_tensor) / keep_prob, x.dtype)
+
+def recompute_gradient(block):
+    """
+    Wraps block(*inputs) such that its intermediate activations are not kept for
+    the backward pass but recomputed from the inputs. Variables have to be passed
+    as inputs, random ops in the block have to be stateless
+    """
+    @tf.custom_gradient
+    def wrapped(*inputs):
+        def grad(dy):
+            # the control dependency delays the recomputation to the backward pass
+            with tf.control_dependencies([dy]):
+                replayed = [tf.identity(tensor) for tensor in inputs]
+            return tf.gradients(block(*replayed), replayed, grad_ys=dy)
+        return block(*inputs), grad
+    return wrapped
 
 def deconv2d(x, W,stride):
     x_shape = tf.shape(x)
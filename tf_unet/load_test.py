@@ -0,0 +1,118 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Load-test client for the inference server (see serve). Concurrent clients
+post random images and the achieved throughput and latency percentiles are
+reported together with the server metrics.
+
+Usage:
+python -m tf_unet.load_test http://127.0.0.1:8080 --concurrency 16 --requests 500 --sizes 256 512
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import io
+import json
+import time
+import argparse
+import threading
+
+try:
+    from urllib.request import Request, urlopen
+except ImportError:
+    from urllib2 import Request, urlopen
+
+import numpy as np
+
+from tf_unet import util
+
+
+def _post_image(url, body, output):
+    request = Request(url + "/predict?output=%s" % output, data=body,
+                      headers={"Content-Type": "application/x-npy"})
+    response = urlopen(request)
+    return response.read()
+
+
+def run_load_test(url, concurrency=8, requests=200, sizes=(512,), channels=1, output="probabilities"):
+    """
+    Posts random images from concurrent clients
+
+    :param url: base url of the server
+    :param concurrency: number of concurrent clients
+    :param requests: total number of requests
+    :param sizes: image edge lengths the requests are drawn from
+    :param channels: number of channels of the net
+
+    :returns results: dict with the throughput, latency percentiles in milliseconds, errors and the server metrics
+    """
+    bodies = []
+    for size in sizes:
+        buffer = io.BytesIO()
+        np.save(buffer, np.random.rand(size, size, channels).astype(np.float32))
+        bodies.append(buffer.getvalue())
+
+    latencies = []
+    errors = []
+    counter = iter(range(requests))
+    lock = threading.Lock()
+
+    def client():
+        while True:
+            with lock:
+                idx = next(counter, None)
+            if idx is None:
+                return
+            start = time.time()
+            try:
+                _post_image(url, bodies[idx % len(bodies)], output)
+                with lock:
+                    latencies.append(time.time() - start)
+            except Exception as error:
+                with lock:
+                    errors.append(str(error))
+
+    start = time.time()
+    clients = [threading.Thread(target=client) for _ in range(concurrency)]
+    for thread in clients:
+        thread.start()
+    for thread in clients:
+        thread.join()
+    elapsed = time.time() - start
+
+    results = {"requests": requests,
+               "errors": len(errors),
+               "elapsed": elapsed,
+               "throughput": len(latencies) / elapsed}
+    results.update(util.latency_stats(latencies))
+    results["server"] = json.loads(urlopen(url + "/metrics").read().decode("utf-8"))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the unet inference server")
+    parser.add_argument("url", nargs="?", default="http://127.0.0.1:8080")
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--sizes", type=int, nargs="+", default=[512])
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--output", default="probabilities", choices=("probabilities", "labels"))
+    args = parser.parse_args()
+
+    results = run_load_test(args.url, args.concurrency, args.requests, args.sizes, args.channels, args.output)
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Background data loading. A pool of worker threads or processes assembles
+batches into a bounded queue while the training loop consumes ready batches.
+
+Usage:
+loader = PrefetchLoader(data_store.open_dataset(Data_path, "train", Train_num), num_workers=4)
+batch_x, batch_y = loader.next()
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import time
+import threading
+import traceback
+import multiprocessing
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+import numpy as np
+
+from tf_unet import util
+from tf_unet.image_util import BaseDataProvider
+
+
+def sample_batch(source, batch_size, out=None):
+    """
+    Draws a random batch from the given source. Samples of an indexable dataset
+    are copied into float32 arrays, reusing `out` if its shapes match. Class
+    index labels stay uint8.
+
+    :param source: indexable dataset (see data_store) or callable data provider (see image_util)
+    :param batch_size: number of samples in the batch
+    :param out: (optional) tuple of preallocated arrays `(batch_x, batch_y)`
+
+    :returns batch_x, batch_y: arrays of shape [n, nx, ny, channels] and [n, nx, ny, n_class]
+    """
+    if isinstance(source, BaseDataProvider):
+        return source(batch_size, out)
+    if callable(source):
+        return source(batch_size)
+
+    indices = np.random.choice(len(source), batch_size)
+    image, label = source[indices[0]]
+    if out is None or out[0].shape[1:] != image.shape or out[1].shape[1:] != label.shape or len(out[0]) != batch_size:
+        out = (np.empty((batch_size,) + image.shape, dtype=np.float32),
+               np.empty((batch_size,) + label.shape, dtype=np.uint8 if label.ndim == 2 else np.float32))
+
+    batch_x, batch_y = out
+    batch_x[0] = image
+    batch_y[0] = label
+    for i in range(1, batch_size):
+        batch_x[i], batch_y[i] = source[indices[i]]
+    return batch_x, batch_y
+
+
+class CropLabels(object):
+    """
+    Batch transform cropping the labels to the shape of the prediction
+
+    :param shape: shape of the prediction
+    """
+
+    def __init__(self, shape):
+        self.shape = shape
+
+    def __call__(self, batch_x, batch_y):
+        return batch_x, util.crop_to_shape(batch_y, self.shape)
+
+
+def _get(items, stop):
+    """
+    Blocking get which gives up once the stop event is set
+    """
+    while not stop.is_set():
+        try:
+            return items.get(timeout=0.1)
+        except queue.Empty:
+            pass
+    raise StopIteration()
+
+
+def _put(items, item, stop):
+    """
+    Blocking put which gives up once the stop event is set
+    """
+    while not stop.is_set():
+        try:
+            items.put(item, timeout=0.1)
+            return
+        except queue.Full:
+            pass
+
+
+class _WorkerError(object):
+    """
+    Failure of a worker, handed to the consumer in place of a batch. Only the formatted
+    traceback is kept such that it can be passed between processes
+    """
+
+    def __init__(self, traceback):
+        self.traceback = traceback
+
+
+def _produce(source, batch_size, augmenter, transform, batches, free, stop, seed):
+    """
+    Worker loop filling the queue until the stop event is set. An error ends the
+    worker and is passed on to the consumer
+    """
+    if seed is not None:
+        np.random.seed(seed)
+
+    while not stop.is_set():
+        try:
+            # recycled buffers are only available to thread workers
+            out = _get(free, stop) if free is not None else None
+        except StopIteration:
+            return
+
+        try:
+            batch = buffers = sample_batch(source, batch_size, out)
+            if augmenter is not None:
+                batch = augmenter(*batch)
+            if transform is not None:
+                batch = transform(*batch)
+        except Exception:
+            _put(batches, _WorkerError(traceback.format_exc()), stop)
+            return
+
+        if free is not None:
+            # the buffers travel with the batch and are recycled by the consumer
+            batch = (batch, buffers)
+        _put(batches, batch, stop)
+
+
+class PrefetchLoader(object):
+    """
+    Loads batches in the background and hands them out in the order they get ready.
+    Thread workers fill a fixed set of reusable float32 buffers, hence a returned
+    batch is only valid until the next call to `next`.
+
+    :param source: indexable dataset (see data_store) or callable data provider (see image_util)
+    :param batch_size: (optional) number of samples per batch
+    :param num_workers: (optional) number of background workers
+    :param queue_size: (optional) maximal number of ready batches
+    :param use_processes: (optional) use processes instead of threads, e.g. if decoding holds the GIL. The processes
+                          are spawned, as forking would copy the TensorFlow runtime, hence the source, the augmenter
+                          and the transform have to be picklable and the main script guarded by `__name__`
+    :param augmenter: (optional) batch augmenter applied in the worker, see augment.BatchAugmenter
+    :param transform: (optional) callable applied to every batch `(batch_x, batch_y)` in the worker after the augmentation
+    """
+
+    def __init__(self, source, batch_size=1, num_workers=2, queue_size=4, use_processes=False, augmenter=None,
+                 transform=None):
+        self.source = source
+        self.batch_size = batch_size
+        self.num_workers = num_workers
+        self.queue_size = queue_size
+        self.use_processes = use_processes
+        self.augmenter = augmenter
+        self.transform = transform
+
+        self.stall_time = 0.0
+        self.batch_count = 0
+        self._start_time = None
+        self._workers = []
+        self._in_use = None
+
+    def start(self):
+        """
+        Starts the background workers
+        """
+        if self._workers:
+            return self
+
+        if self.use_processes:
+            # forked workers would inherit the TensorFlow runtime of the training process
+            context = multiprocessing.get_context("spawn") if hasattr(multiprocessing, "get_context") else multiprocessing
+            self._batches = context.Queue(self.queue_size)
+            self._free = None
+            self._stop = context.Event()
+            worker_type = context.Process
+        else:
+            self._batches = queue.Queue(self.queue_size)
+            # enough buffers for a full queue, one per worker and the one held by the consumer,
+            # they are allocated by the workers on first use
+            self._free = queue.Queue()
+            for _ in range(self.queue_size + self.num_workers + 1):
+                self._free.put(None)
+            self._stop = threading.Event()
+            worker_type = threading.Thread
+
+        # processes inherit the random state, hence every worker gets its own seed
+        seeds = np.random.randint(2**31 - 1, size=self.num_workers)
+        for i in range(self.num_workers):
+            worker = worker_type(target=_produce, args=(self.source, self.batch_size, self.augmenter, self.transform,
+                                                        self._batches, self._free, self._stop,
+                                                        seeds[i] if self.use_processes else None))
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+        self._start_time = time.time()
+        return self
+
+    def next(self):
+        """
+        Returns the next ready batch, blocks until one is available. Raises a RuntimeError
+        if a worker failed to load a batch
+
+        :returns batch_x, batch_y: the batch
+        """
+        if not self._workers:
+            self.start()
+
+        if self._in_use is not None:
+            self._free.put(self._in_use)
+            self._in_use = None
+
+        start = time.time()
+        batch = self._batches.get()
+        self.stall_time += time.time() - start
+        if isinstance(batch, _WorkerError):
+            raise RuntimeError("Loading a batch failed in a background worker:\n%s" % batch.traceback)
+        self.batch_count += 1
+
+        if self._free is not None:
+            batch, self._in_use = batch
+        return batch
+
+    __next__ = next
+
+    def __iter__(self):
+        return self
+
+    def stats(self):
+        """
+        Returns the time the consumer was stalled waiting for input
+
+        :returns stats: dict with the number of batches, total and mean stall time and the stalled fraction of the wall time
+        """
+        elapsed = time.time() - self._start_time if self._start_time is not None else 0.0
+        return {"batches": self.batch_count,
+                "stall_time": self.stall_time,
+                "mean_stall": self.stall_time / max(self.batch_count, 1),
+                "stall_fraction": self.stall_time / elapsed if elapsed > 0 else 0.0}
+
+    def stop(self):
+        """
+        Stops the background workers and the loading threads of a data provider
+        """
+        if not self._workers:
+            return
+
+        self._stop.set()
+        for worker in self._workers:
+            worker.join(timeout=1.0)
+            if self.use_processes and worker.is_alive():
+                worker.terminate()
+        self._workers = []
+        if isinstance(self.source, BaseDataProvider):
+            self.source.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *args):
+        self.stop()
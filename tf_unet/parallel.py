@@ -0,0 +1,266 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Data-parallel training on a single machine. Every worker process trains a
+replica of the net on its own shard of the training samples, the gradients
+are averaged in shared memory after every step such that the replicas stay
+identical. Rank 0 broadcasts the initial weights and is the only one writing
+checkpoints, summaries, images and logs.
+
+Every step processes num_workers * batch_size samples, the learning rate
+applies to the gradient averaged over all of them.
+
+Usage:
+net_fn = functools.partial(unet.Unet, channels=1, n_class=6, layers=3, features_root=64)
+path = train_parallel(net_fn, Unet_path, Data_path, Train_num, Veri_num, num_workers=4,
+                      trainer_kwargs=dict(optimizer="momentum", opt_kwargs=dict(momentum=0.9)),
+                      training_iters=200, epochs=100)
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import time
+import ctypes
+import logging
+import multiprocessing
+
+import numpy as np
+import tensorflow as tf
+
+from tf_unet import unet
+
+
+class SharedMemoryAllReduce(object):
+    """
+    Averages float32 arrays across the worker processes through shared memory. Every
+    worker writes its arrays to its own slot, then each worker averages one chunk of
+    the slots into the shared result.
+
+    :param size: total number of values of the reduced arrays
+    :param num_workers: number of worker processes
+    :param context: (optional) multiprocessing context the shared memory is created with
+    """
+
+    def __init__(self, size, num_workers, context=multiprocessing):
+        self.size = size
+        self.num_workers = num_workers
+        self._slots = context.RawArray(ctypes.c_float, num_workers * size)
+        self._result = context.RawArray(ctypes.c_float, size)
+        self._barrier = context.Barrier(num_workers)
+        self._views = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_views"] = None
+        return state
+
+    def _get_views(self):
+        if self._views is None:
+            self._views = (np.frombuffer(self._slots, dtype=np.float32).reshape(self.num_workers, self.size),
+                           np.frombuffer(self._result, dtype=np.float32))
+        return self._views
+
+    def _split(self, flat, arrays):
+        outputs = []
+        offset = 0
+        for array in arrays:
+            outputs.append(flat[offset:offset + array.size].reshape(array.shape))
+            offset += array.size
+        return outputs
+
+    def all_reduce(self, rank, arrays):
+        """
+        Averages the arrays over all workers, blocks until every worker contributed
+
+        :param rank: rank of the calling worker
+        :param arrays: list of arrays with `size` values in total
+
+        :returns averages: list of the averaged arrays, valid until the next call
+        """
+        slots, result = self._get_views()
+        for slot, array in zip(self._split(slots[rank], arrays), arrays):
+            slot[...] = array
+        self._barrier.wait()
+
+        chunk = int(np.ceil(self.size / self.num_workers))
+        start, stop = rank * chunk, min(self.size, (rank + 1) * chunk)
+        if start < stop:
+            np.mean(slots[:, start:stop], axis=0, out=result[start:stop])
+        self._barrier.wait()
+        # a slot is only written again once its worker has read the result
+        return self._split(result, arrays)
+
+    def broadcast(self, rank, arrays, root=0):
+        """
+        Copies the arrays of the root worker to all workers
+
+        :returns arrays: list of copies of the root's arrays
+        """
+        _, result = self._get_views()
+        if rank == root:
+            for target, array in zip(self._split(result, arrays), arrays):
+                target[...] = array
+        self._barrier.wait()
+        arrays = [array.copy() for array in self._split(result, arrays)]
+        self._barrier.wait()
+        return arrays
+
+
+class Shard(object):
+    """
+    Every num_workers-th sample of an indexable dataset starting at rank
+
+    :param dataset: indexable dataset, see data_store
+    """
+
+    def __init__(self, dataset, rank, num_workers):
+        self.dataset = dataset
+        self.rank = rank
+        self.num_workers = num_workers
+
+    def __len__(self):
+        return len(range(self.rank, len(self.dataset), self.num_workers))
+
+    def __getitem__(self, idx):
+        return self.dataset[self.rank + idx * self.num_workers]
+
+
+class ParallelTrainer(unet.Trainer):
+    """
+    Trainer of one replica, the gradients are averaged with the other workers before every update
+
+    :param net: the unet instance to train
+    :param rank: rank of the worker, rank 0 is the chief
+    :param all_reduce: the SharedMemoryAllReduce shared by the workers
+    :param kwargs: (optional) passed to unet.Trainer
+    """
+
+    def __init__(self, net, rank, all_reduce, **kwargs):
+        super(ParallelTrainer, self).__init__(net, **kwargs)
+        if self.accumulation_steps != 1:
+            raise ValueError("Gradient accumulation is not supported by the parallel trainer, "
+                             "increase the number of workers instead")
+        if net.iterator is not None:
+            # every rank would read the whole in-graph pipeline instead of its own shard
+            raise ValueError("Nets reading from an input_fn are not supported by the parallel trainer, "
+                             "feed the data through Data_path instead")
+        self.rank = rank
+        self.num_workers = all_reduce.num_workers
+        self.all_reduce = all_reduce
+        self.is_chief = rank == 0
+
+    def _build_train_op(self, optimizer, global_step):
+        grads_and_vars = [(gradient, variable) for gradient, variable in optimizer.compute_gradients(self.net.cost)
+                          if gradient is not None]
+        self._gradients = [gradient for gradient, _ in grads_and_vars]
+        self._variables = [variable for _, variable in grads_and_vars]
+
+        size = sum(int(np.prod(variable.get_shape().as_list())) for variable in self._variables)
+        if size != self.all_reduce.size:
+            raise ValueError("The net has %s parameters, the all-reduce expects %s" % (size, self.all_reduce.size))
+
+        # the update is computed from the averaged gradients fed back into the graph
+        self._averaged_gradients = [tf.placeholder(gradient.dtype, gradient.get_shape()) for gradient in self._gradients]
+        averaged = list(zip(self._averaged_gradients, self._variables))
+        return averaged, optimizer.apply_gradients(averaged, global_step=global_step)
+
+    def _train_step(self, sess, feed_dict, options=None, run_metadata=None):
+        gradients, loss, lr = sess.run((self._gradients, self.net.cost, self.learning_rate_node),
+                                       feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        averaged = self.all_reduce.all_reduce(self.rank, gradients)
+        sess.run(self.optimizer, feed_dict=dict(zip(self._averaged_gradients, averaged)))
+        return loss, lr
+
+    def _synchronize(self, sess):
+        values = sess.run(self._variables) if self.is_chief else [np.empty(variable.get_shape().as_list(), np.float32)
+                                                                  for variable in self._variables]
+        for variable, value in zip(self._variables, self.all_reduce.broadcast(self.rank, values)):
+            variable.load(value, sess)
+
+    def _open_sources(self, Data_path, Train_num, Veri_num):
+        train_data, veri_data = super(ParallelTrainer, self)._open_sources(Data_path, Train_num, Veri_num)
+        if not callable(train_data):
+            # callable data providers draw random samples and are not sharded
+            train_data = Shard(train_data, self.rank, self.num_workers)
+        return train_data, veri_data
+
+
+def count_parameters(net_fn):
+    """
+    Number of trainable values of the net built by net_fn, the net is built in a separate graph
+    """
+    with tf.Graph().as_default():
+        net_fn()
+        return sum(int(np.prod(variable.get_shape().as_list())) for variable in tf.trainable_variables())
+
+
+def _work(rank, net_fn, all_reduce, threads, trainer_kwargs, train_args, train_kwargs, results):
+    if rank != 0:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    net = net_fn()
+    trainer = ParallelTrainer(net, rank, all_reduce, **trainer_kwargs)
+    trainer.session_config = tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                            inter_op_parallelism_threads=2)
+    save_path = trainer.train(*train_args, **train_kwargs)
+    if rank == 0:
+        results.put(save_path)
+
+
+def train_parallel(net_fn, Unet_path, Data_path, Train_num, Veri_num, num_workers=2, trainer_kwargs={},
+                   threads_per_worker=None, **train_kwargs):
+    """
+    Trains the net with data-parallel worker processes
+
+    :param net_fn: picklable callable building the net, e.g. a functools.partial of unet.Unet
+    :param Unet_path: path where to store checkpoints
+    :param Data_path: directory containing the .mat files or a packed store (see data_store)
+    :param Train_num: number of training samples
+    :param Veri_num: number of verification samples
+    :param num_workers: (optional) number of worker processes
+    :param trainer_kwargs: (optional) kwargs passed to the unet.Trainer
+    :param threads_per_worker: (optional) intra op threads of every worker, the cores are split evenly by default
+    :param train_kwargs: (optional) kwargs passed to unet.Trainer.train
+
+    :returns save_path: path of the last checkpoint
+    """
+    # forked workers would inherit the TensorFlow runtime of the parent
+    context = multiprocessing.get_context("spawn") if hasattr(multiprocessing, "get_context") else multiprocessing
+    if threads_per_worker is None:
+        threads_per_worker = max(1, multiprocessing.cpu_count() // num_workers)
+
+    all_reduce = SharedMemoryAllReduce(count_parameters(net_fn), num_workers, context)
+    results = context.Queue()
+    train_args = (Unet_path, Data_path, Train_num, Veri_num)
+    workers = [context.Process(target=_work, args=(rank, net_fn, all_reduce, threads_per_worker, trainer_kwargs,
+                                                   train_args, train_kwargs, results))
+               for rank in range(num_workers)]
+    for worker in workers:
+        worker.start()
+
+    # a failed worker would leave the others waiting at the barrier forever
+    try:
+        while any(worker.is_alive() for worker in workers):
+            if any(worker.exitcode not in (None, 0) for worker in workers):
+                raise RuntimeError("A training worker failed")
+            time.sleep(1)
+        if any(worker.exitcode != 0 for worker in workers):
+            raise RuntimeError("A training worker failed")
+    finally:
+        for worker in workers:
+            if worker.is_alive():
+                worker.terminate()
+            worker.join()
+
+    return results.get()
@@ -0,0 +1,186 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Long-lived inference. The checkpoint is restored once and the session is kept
+warm across calls.
+
+Usage:
+net = unet.Unet(channels=1, n_class=6, layers=3, features_root=64)
+with Predictor(net, "trained_models/") as predictor:
+    prediction = predictor(x_test)
+
+or with a graph frozen by export.export_inference_graph:
+predictor = Predictor.from_frozen_graph("unet_frozen.pb")
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import os
+import time
+import logging
+from collections import deque
+
+import numpy as np
+import tensorflow as tf
+
+from tf_unet import util
+from tf_unet import tiling
+
+
+def resolve_checkpoint(model_path):
+    """
+    Resolves a checkpoint directory to its latest checkpoint, checkpoint prefixes are returned as is
+
+    :param model_path: checkpoint directory or prefix
+    """
+    if os.path.isdir(model_path):
+        checkpoint = tf.train.latest_checkpoint(model_path)
+        if checkpoint is None:
+            raise ValueError("No checkpoint found in '%s'" % model_path)
+        return checkpoint
+    return model_path
+
+
+def load_frozen_graph(path, input_name="x", output_name="prediction"):
+    """
+    Loads an inference graph written by export.export_inference_graph
+
+    :param path: path of the frozen graph protobuf
+    :param input_name: (optional) name of the input placeholder
+    :param output_name: (optional) name of the class probability tensor
+
+    :returns graph, x, prediction: the graph with its input and output tensors
+    """
+    graph_def = tf.GraphDef()
+    with tf.gfile.GFile(path, "rb") as f:
+        graph_def.ParseFromString(f.read())
+
+    graph = tf.Graph()
+    with graph.as_default():
+        tf.import_graph_def(graph_def, name="")
+    return graph, graph.get_tensor_by_name(input_name + ":0"), graph.get_tensor_by_name(output_name + ":0")
+
+
+class Predictor(object):
+    """
+    Restores a trained net once and predicts with a persistent session. The
+    label placeholder is never fed.
+
+    :param net: the unet instance, built in the current default graph
+    :param model_path: checkpoint directory or prefix to restore
+    :param config: (optional) tf.ConfigProto of the session
+    :param window: (optional) number of recent calls the latency statistics are computed on
+    """
+
+    def __init__(self, net, model_path, config=None, window=1000):
+        graph = net.x.graph
+        with graph.as_default():
+            saver = tf.train.Saver()
+        sess = tf.Session(graph=graph, config=config)
+        model_path = resolve_checkpoint(model_path)
+        saver.restore(sess, model_path)
+        logging.info("Model restored from file: %s" % model_path)
+
+        self._setup(sess, net.x, net.predicter, {net.keep_prob: 1.}, net.n_class, window)
+
+    @classmethod
+    def from_frozen_graph(cls, path, config=None, window=1000):
+        """
+        Creates a predictor on a frozen inference graph, see export.export_inference_graph
+
+        :param path: path of the frozen graph protobuf
+        :param config: (optional) tf.ConfigProto of the session
+        :param window: (optional) number of recent calls the latency statistics are computed on
+        """
+        graph, x, output = load_frozen_graph(path)
+        predictor = cls.__new__(cls)
+        predictor._setup(tf.Session(graph=graph, config=config), x, output, {}, output.shape[-1].value, window)
+        return predictor
+
+    def _setup(self, sess, x, output, feed, n_class, window):
+        self.sess = sess
+        self.graph = sess.graph
+        self.x = x
+        self.output = output
+        self.feed = feed
+        self.n_class = n_class
+
+        self.latencies = deque(maxlen=window)
+        self.image_count = 0
+
+    def _run(self, batch_x):
+        feed_dict = dict(self.feed)
+        feed_dict[self.x] = batch_x
+
+        start = time.time()
+        prediction = self.sess.run(self.output, feed_dict=feed_dict)
+        self.latencies.append(time.time() - start)
+        self.image_count += len(batch_x)
+        return prediction
+
+    def __call__(self, x):
+        """
+        Predicts a single image or a batch
+
+        :param x: image of shape [nx, ny, channels] or batch of shape [n, nx, ny, channels]
+
+        :returns prediction: class probabilities of shape [nx, ny, n_class] or [n, nx, ny, n_class]
+        """
+        if x.ndim == 3:
+            return self._run(x[np.newaxis])[0]
+        return self._run(x)
+
+    def predict_batch(self, images):
+        """
+        Predicts a list of equally shaped images in one forward pass
+
+        :param images: list of images of shape [nx, ny, channels]
+
+        :returns predictions: list of class probabilities of shape [nx, ny, n_class]
+        """
+        return list(self._run(np.stack(images)))
+
+    def predict_tiled(self, image, **kwargs):
+        """
+        Predicts a large image in overlapping tiles with bounded memory, see tiling.predict_tiled
+
+        :param image: the image of shape [nx, ny, channels]
+        :param kwargs: (optional) tiling parameters, e.g. tile_size, overlap and memory_budget_mb.
+                       layers, features_root and pool_size have to match the net
+
+        :returns prediction: class probabilities of shape [nx, ny, n_class]
+        """
+        return tiling.predict_tiled(self._run, image, self.n_class, **kwargs)
+
+    def stats(self):
+        """
+        Latency statistics of the recent calls in milliseconds
+
+        :returns stats: dict with the number of 'calls' and 'images', 'mean', 'p50', 'p90' and 'p99'
+        """
+        stats = {"calls": len(self.latencies), "images": self.image_count}
+        stats.update(util.latency_stats(self.latencies))
+        return stats
+
+    def close(self):
+        """
+        Closes the session
+        """
+        self.sess.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
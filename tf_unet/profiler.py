@@ -0,0 +1,152 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Step-time breakdown of the training loop. The wall-clock time of every phase
+(loading, the session run, prediction images, verification, checkpointing) is
+recorded, rolling percentiles are reported and every step is appended to a
+JSON lines log. Sampled steps can additionally be traced with the TensorFlow
+RunMetadata and written as Chrome traces (chrome://tracing).
+
+Usage:
+profiler = StepProfiler("output/profile.jsonl", trace_path="output/", trace_steps=1000)
+with profiler.phase("load"):
+    batch_x, batch_y = train_loader.next()
+options, run_metadata = profiler.run_options(step)
+with profiler.phase("run"):
+    sess.run(train_op, options=options, run_metadata=run_metadata)
+profiler.end_step(step, run_metadata)
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import os
+import json
+import time
+from contextlib import contextmanager
+from collections import OrderedDict, deque
+
+import tensorflow as tf
+from tensorflow.python.client import timeline
+
+from tf_unet import util
+
+
+class StepProfiler(object):
+    """
+    Records per phase wall-clock timings of the training steps
+
+    :param log_path: (optional) JSON lines file the timings of every step are appended to
+    :param trace_path: (optional) directory the Chrome traces are written to
+    :param trace_steps: (optional) interval of the steps traced with RunMetadata, no tracing if None
+    :param window: (optional) number of recent records the percentiles are computed on
+    """
+
+    def __init__(self, log_path=None, trace_path=None, trace_steps=None, window=1000):
+        self.trace_path = trace_path
+        self.trace_steps = trace_steps
+        self.window = window
+        self.timings = OrderedDict()
+        self._pending = OrderedDict()
+        self._step_start = None
+        self._log = None
+        if log_path is not None:
+            self._log = open(log_path, "a", 1)
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Times the enclosed block as the phase `name` of the current step
+        """
+        start = time.time()
+        if self._step_start is None:
+            self._step_start = start
+        try:
+            yield
+        finally:
+            self._pending[name] = self._pending.get(name, 0.) + time.time() - start
+
+    def run_options(self, step):
+        """
+        Options of the session run, the run is traced if the step is sampled
+
+        :returns options, run_metadata: the tf.RunOptions and tf.RunMetadata or None, None
+        """
+        if self.trace_steps is None or self.trace_path is None or step % self.trace_steps != 0:
+            return None, None
+        return tf.RunOptions(trace_level=tf.RunOptions.FULL_TRACE), tf.RunMetadata()
+
+    def end_step(self, step, run_metadata=None, **fields):
+        """
+        Closes the phases recorded since the last call and appends them to the log together
+        with the total time of the step
+
+        :param step: the training step
+        :param run_metadata: (optional) metadata of a traced run, written as Chrome trace
+        :param fields: (optional) further values logged with the step, e.g. the loss
+        """
+        if not self._pending:
+            return
+
+        self._pending["step"] = time.time() - self._step_start
+        if run_metadata is not None and run_metadata.step_stats.dev_stats:
+            self._write_trace(step, run_metadata)
+        self._flush("step", step, fields)
+
+    def end_epoch(self, epoch, **fields):
+        """
+        Closes the phases recorded once per epoch (prediction images, verification, checkpointing)
+        and appends them to the log
+        """
+        if self._pending:
+            self._flush("epoch", epoch, fields)
+
+    def _flush(self, key, value, fields):
+        for name, elapsed in self._pending.items():
+            self.timings.setdefault(name, deque(maxlen=self.window)).append(elapsed)
+
+        if self._log is not None:
+            record = OrderedDict([(key, value), ("time", time.time())])
+            record["phases"] = OrderedDict((name, 1000 * elapsed) for name, elapsed in self._pending.items())
+            record.update(fields)
+            self._log.write(json.dumps(record) + "\n")
+
+        self._pending = OrderedDict()
+        self._step_start = None
+
+    def _write_trace(self, step, run_metadata):
+        trace = timeline.Timeline(run_metadata.step_stats).generate_chrome_trace_format()
+        with open(os.path.join(self.trace_path, "timeline_%s.json" % step), "w") as f:
+            f.write(trace)
+
+    def stats(self):
+        """
+        Rolling statistics of the phases in milliseconds
+
+        :returns stats: dict mapping the phase names to dicts with the 'mean', 'p50', 'p90' and 'p99'
+        """
+        stats = OrderedDict()
+        for name, timings in self.timings.items():
+            stats[name] = util.latency_stats(timings)
+        return stats
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
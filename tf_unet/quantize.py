@@ -0,0 +1,318 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Post-training quantization for CPU inference. A trained checkpoint is frozen
+with export.export_inference_graph and converted to a TensorFlow Lite model,
+either with int8 weights and activations whose ranges are calibrated on a
+sample of verification images, or with int8 weights only. The per-class Dice
+and the latency of the quantized model are reported against the float graph.
+
+Usage:
+python -m tf_unet.quantize TrainedModels/ unet_int8.tflite Data/Train/ --veri-num 504 --channels 1 --n-class 6 --layers 3 --features-root 64 --report quantization.json
+
+with QuantizedPredictor("unet_int8.tflite") as predictor:
+    prediction = predictor(x_test)
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import os
+import json
+import time
+import logging
+import argparse
+from collections import OrderedDict, deque
+
+import numpy as np
+import tensorflow as tf
+
+from tf_unet import util
+from tf_unet import export
+from tf_unet import predictor
+from tf_unet import data_store
+from tf_unet import evaluation
+
+MODES = ("int8", "weights")
+
+
+def representative_dataset(dataset, indices):
+    """
+    Calibration samples for the converter, one image per batch
+
+    :param dataset: indexable dataset of `(image, label)`, see data_store
+    :param indices: indices of the calibration samples
+    """
+    def generate():
+        for idx in indices:
+            image, _ = dataset[idx]
+            yield [np.asarray(image, dtype=np.float32)[np.newaxis]]
+    return tf.lite.RepresentativeDataset(generate)
+
+
+def convert(frozen_graph, input_shape, mode="int8", representative_data=None):
+    """
+    Converts a frozen inference graph to a quantized TensorFlow Lite model. The input and
+    the class probabilities stay float32, ops without an int8 kernel fall back to float
+
+    :param frozen_graph: path of the graph written by export.export_inference_graph
+    :param input_shape: shape [nx, ny, channels] of the images, the model is converted for this shape
+    :param mode: (optional) 'int8' for int8 weights and activations, 'weights' for int8 weights only
+    :param representative_data: (optional) calibration samples, required by the 'int8' mode
+
+    :returns model: the serialized TensorFlow Lite model
+    """
+    if mode not in MODES:
+        raise ValueError("Unknown mode: %s" % mode)
+
+    converter = tf.lite.TFLiteConverter.from_frozen_graph(frozen_graph, [export.INPUT_NAME], [export.OUTPUT_NAME],
+                                                          input_shapes={export.INPUT_NAME: [1] + list(input_shape)})
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if mode == "int8":
+        if representative_data is None:
+            raise ValueError("The int8 mode needs representative data to calibrate the activation ranges")
+        converter.representative_dataset = representative_data
+    return converter.convert()
+
+
+class QuantizedPredictor(object):
+    """
+    Predicts with a TensorFlow Lite model written by `quantize`. The model only accepts
+    images of the shape it was converted for, batches are run image by image. Tiled
+    prediction of larger images is not supported
+
+    :param model_path: path of the .tflite model
+    :param window: (optional) number of recent calls the latency statistics are computed on
+    """
+
+    def __init__(self, model_path, window=1000):
+        self.interpreter = tf.lite.Interpreter(model_path=model_path)
+        self.interpreter.allocate_tensors()
+        self._input = self.interpreter.get_input_details()[0]
+        self._output = self.interpreter.get_output_details()[0]
+        self.input_shape = tuple(int(size) for size in self._input["shape"][1:])
+        self.n_class = int(self._output["shape"][-1])
+
+        self.latencies = deque(maxlen=window)
+        self.image_count = 0
+
+    def _run(self, batch_x):
+        if tuple(batch_x.shape[1:]) != self.input_shape:
+            raise ValueError("The model was converted for images of shape %s, got %s"
+                             % (self.input_shape, tuple(batch_x.shape[1:])))
+
+        start = time.time()
+        prediction = np.empty(batch_x.shape[:3] + (self.n_class,), dtype=np.float32)
+        for i in range(len(batch_x)):
+            self.interpreter.set_tensor(self._input["index"], batch_x[i:i + 1].astype(self._input["dtype"]))
+            self.interpreter.invoke()
+            prediction[i] = self.interpreter.get_tensor(self._output["index"])[0]
+        self.latencies.append(time.time() - start)
+        self.image_count += len(batch_x)
+        return prediction
+
+    def __call__(self, x):
+        """
+        Predicts a single image or a batch
+
+        :param x: image of shape [nx, ny, channels] or batch of shape [n, nx, ny, channels]
+
+        :returns prediction: class probabilities of shape [nx, ny, n_class] or [n, nx, ny, n_class]
+        """
+        if x.ndim == 3:
+            return self._run(x[np.newaxis])[0]
+        return self._run(x)
+
+    def predict_batch(self, images):
+        """
+        Predicts a list of images of the converted shape
+
+        :returns predictions: list of class probabilities of shape [nx, ny, n_class]
+        """
+        return list(self._run(np.stack(images)))
+
+    def stats(self):
+        """
+        Latency statistics of the recent calls in milliseconds, see predictor.Predictor.stats
+        """
+        stats = {"calls": len(self.latencies), "images": self.image_count}
+        stats.update(util.latency_stats(self.latencies))
+        return stats
+
+    def close(self):
+        self.interpreter = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _class_index(label):
+    return label if label.ndim == 2 else util.to_class_index(label)
+
+
+def evaluate(model, dataset, indices, n_class):
+    """
+    Confusion matrix of a predictor on the given samples, predicted one image per call.
+    The first sample is predicted once more beforehand such that the latencies are warm
+
+    :param model: a predictor.Predictor or QuantizedPredictor
+    :param dataset: indexable dataset of `(image, label)`, see data_store
+    :param indices: indices of the evaluated samples
+
+    :returns confusion: matrix of shape [n_class, n_class], see evaluation.confusion_matrix
+    """
+    model(np.asarray(dataset[indices[0]][0], dtype=np.float32))
+    model.latencies.clear()
+    model.image_count = 0
+
+    confusion = np.zeros((n_class, n_class), dtype=np.int64)
+    for idx in indices:
+        image, label = dataset[idx]
+        prediction = model(np.asarray(image, dtype=np.float32))
+        confusion += evaluation.confusion_matrix(np.argmax(prediction, -1), _class_index(label), n_class)
+    return confusion
+
+
+def _to_list(values):
+    # NaN marks classes which neither occur nor are predicted
+    return [None if np.isnan(value) else float(value) for value in values]
+
+
+def compare_models(frozen_graph, quantized_model, dataset, n_class, indices=None, config=None):
+    """
+    Per-class Dice and latency of the quantized model and the float graph on the same samples
+
+    :param frozen_graph: path of the float graph written by export.export_inference_graph
+    :param quantized_model: path of the .tflite model
+    :param dataset: indexable dataset of `(image, label)`, see data_store
+    :param n_class: number of output labels
+    :param indices: (optional) indices of the evaluated samples, all by default
+    :param config: (optional) tf.ConfigProto of the float session
+
+    :returns report: dict with the Dice per class and its mean, the latency percentiles in milliseconds,
+                     the speedup and the model sizes in MB
+    """
+    if indices is None:
+        indices = list(range(len(dataset)))
+
+    with predictor.Predictor.from_frozen_graph(frozen_graph, config=config) as float_model:
+        float_dice = evaluation.dice_coefficients(evaluate(float_model, dataset, indices, n_class))
+        float_latency = float_model.stats()
+    with QuantizedPredictor(quantized_model) as quantized:
+        quantized_dice = evaluation.dice_coefficients(evaluate(quantized, dataset, indices, n_class))
+        quantized_latency = quantized.stats()
+
+    return OrderedDict([("samples", len(indices)),
+                        ("float_dice", _to_list(float_dice)),
+                        ("quantized_dice", _to_list(quantized_dice)),
+                        ("dice_difference", _to_list(quantized_dice - float_dice)),
+                        ("float_mean_dice", float(np.nanmean(float_dice))),
+                        ("quantized_mean_dice", float(np.nanmean(quantized_dice))),
+                        ("float_latency", float_latency),
+                        ("quantized_latency", quantized_latency),
+                        ("speedup", float_latency["mean"] / quantized_latency["mean"]),
+                        ("float_size_mb", os.path.getsize(frozen_graph) / 2**20),
+                        ("quantized_size_mb", os.path.getsize(quantized_model) / 2**20)])
+
+
+def quantize(model_path, output_file, Data_path, Veri_num, channels, n_class, mode="int8", calibration_samples=100,
+             evaluation_samples=None, report_path=None, seed=1, **kwargs):
+    """
+    Freezes a trained checkpoint, converts it to a quantized TensorFlow Lite model and compares
+    it with the float graph on the verification samples not used for the calibration
+
+    :param model_path: checkpoint directory or prefix written by Unet.save
+    :param output_file: path of the .tflite model, the float graph is written next to it
+    :param Data_path: directory containing the verification .mat files or a packed store (see data_store)
+    :param Veri_num: number of verification samples
+    :param channels: number of channels in the input image
+    :param n_class: number of output labels
+    :param mode: (optional) 'int8' for int8 weights and activations, 'weights' for int8 weights only
+    :param calibration_samples: (optional) number of randomly drawn verification images calibrating the activation ranges
+    :param evaluation_samples: (optional) number of verification images the models are compared on, all images
+                               not drawn for the calibration by default
+    :param report_path: (optional) path of the JSON report
+    :param seed: (optional) seed of the calibration sample
+    :param kwargs: (optional) net parameters passed to unet.create_conv_net, e.g. layers and features_root
+
+    :returns report: the comparison, see compare_models
+    """
+    frozen_graph = os.path.splitext(output_file)[0] + "_float.pb"
+    export.export_inference_graph(model_path, frozen_graph, channels, n_class, **kwargs)
+
+    dataset = data_store.open_dataset(Data_path, "verification", Veri_num)
+    input_shape = dataset[0][0].shape
+
+    representative_data = None
+    calibration = np.array([], dtype=np.int64)
+    if mode == "int8":
+        calibration = np.sort(np.random.RandomState(seed).choice(len(dataset), min(calibration_samples, len(dataset)),
+                                                                 replace=False))
+        representative_data = representative_dataset(dataset, calibration)
+
+    # the calibration images would bias the comparison in favour of the quantized model
+    indices = list(np.setdiff1d(np.arange(len(dataset)), calibration))[:evaluation_samples]
+    if not indices:
+        raise ValueError("No verification samples left for the evaluation, reduce calibration_samples")
+
+    model = convert(frozen_graph, input_shape, mode, representative_data)
+    with open(output_file, "wb") as f:
+        f.write(model)
+    logging.info("Quantized model written to '{:}'".format(output_file))
+
+    report = compare_models(frozen_graph, output_file, dataset, n_class, indices)
+    report["mode"] = mode
+    report["calibration_samples"] = len(calibration)
+
+    for cls, (float_dice, quantized_dice) in enumerate(zip(report["float_dice"], report["quantized_dice"])):
+        logging.info("Class {:}: float Dice {:}, quantized Dice {:}".format(cls, float_dice, quantized_dice))
+    logging.info("Mean Dice {:.4f} / {:.4f}, latency {:.1f} / {:.1f} ms, speedup {:.2f}x".format(
+        report["float_mean_dice"], report["quantized_mean_dice"], report["float_latency"]["mean"],
+        report["quantized_latency"]["mean"], report["speedup"]))
+
+    if report_path is not None:
+        with open(report_path, "w") as f:
+            json.dump(report, f, indent=2)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Quantizes a trained unet checkpoint for CPU inference")
+    parser.add_argument("model_path", help="checkpoint directory or prefix")
+    parser.add_argument("output_file", help="path of the .tflite model")
+    parser.add_argument("data_path", help="directory of the verification data")
+    parser.add_argument("--veri-num", type=int, default=504)
+    parser.add_argument("--mode", default="int8", choices=MODES)
+    parser.add_argument("--calibration-samples", type=int, default=100)
+    parser.add_argument("--evaluation-samples", type=int, default=None)
+    parser.add_argument("--report", default=None, help="path of the JSON report")
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--n-class", type=int, default=6)
+    parser.add_argument("--layers", type=int, default=3)
+    parser.add_argument("--features-root", type=int, default=64)
+    parser.add_argument("--filter-size", type=int, default=3)
+    parser.add_argument("--pool-size", type=int, default=2)
+    args = parser.parse_args()
+
+    quantize(args.model_path, args.output_file, args.data_path, args.veri_num, args.channels, args.n_class,
+             mode=args.mode, calibration_samples=args.calibration_samples,
+             evaluation_samples=args.evaluation_samples, report_path=args.report,
+             layers=args.layers, features_root=args.features_root,
+             filter_size=args.filter_size, pool_size=args.pool_size)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,209 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Local HTTP inference server. The checkpoint is loaded once, the requests are
+run through a dynamic batcher.
+
+Endpoints:
+POST /predict?output=probabilities|labels  body: raw .npy array [nx, ny(, channels)] or a PNG image.
+                                           Returns a .npy array, labels are returned as PNG if requested
+                                           with 'Accept: image/png'
+GET  /metrics                              queue depth, batch size histogram and latency percentiles as JSON
+GET  /health
+
+Usage:
+python -m tf_unet.serve TrainedModels/ --channels 1 --n-class 6 --layers 3 --features-root 64 --port 8080
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import io
+import json
+import logging
+import argparse
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+import numpy as np
+import tensorflow as tf
+from PIL import Image
+
+from tf_unet import unet
+from tf_unet.predictor import Predictor
+from tf_unet.batching import DynamicBatcher
+
+
+def decode_image(body, content_type, channels):
+    """
+    Decodes a request body into an image of shape [nx, ny, channels]. PNG images are scaled to [0, 1]
+
+    :param body: the raw request body
+    :param content_type: 'image/png' or any other type for .npy arrays
+    :param channels: number of channels of the net
+    """
+    if content_type == "image/png":
+        image = np.array(Image.open(io.BytesIO(body)))
+        scale = np.iinfo(image.dtype).max if image.dtype.kind in "ui" else 1.
+        image = image.astype(np.float32) / scale
+    else:
+        image = np.load(io.BytesIO(body), allow_pickle=False).astype(np.float32)
+
+    if image.ndim == 2:
+        image = image[..., np.newaxis]
+    if image.ndim != 3 or image.shape[2] != channels:
+        raise ValueError("Expected an image with %s channels, got shape %s" % (channels, image.shape))
+    return image
+
+
+def encode_prediction(prediction, output, accept):
+    """
+    Encodes the class probabilities as requested
+
+    :returns body, content_type: the response
+    """
+    if output == "labels":
+        prediction = np.argmax(prediction, axis=-1).astype(np.uint8)
+        if accept == "image/png":
+            buffer = io.BytesIO()
+            Image.fromarray(prediction).save(buffer, "PNG")
+            return buffer.getvalue(), "image/png"
+
+    buffer = io.BytesIO()
+    np.save(buffer, prediction)
+    return buffer.getvalue(), "application/x-npy"
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class InferenceHandler(BaseHTTPRequestHandler):
+    """
+    Request handler, the server provides the `batcher`, `predictor` and `channels` attributes
+    """
+
+    def _respond(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _respond_json(self, code, content):
+        self._respond(code, json.dumps(content).encode("utf-8"), "application/json")
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path == "/metrics":
+            metrics = self.server.batcher.stats()
+            metrics["batch_sizes"] = dict((str(size), count) for size, count in metrics["batch_sizes"].items())
+            metrics["forward_pass"] = self.server.predictor.stats()
+            self._respond_json(200, metrics)
+        elif path == "/health":
+            self._respond_json(200, {"status": "ok"})
+        else:
+            self._respond_json(404, {"error": "Unknown path: %s" % path})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        if url.path != "/predict":
+            self._respond_json(404, {"error": "Unknown path: %s" % url.path})
+            return
+
+        output = parse_qs(url.query).get("output", ["probabilities"])[0]
+        if output not in ("probabilities", "labels"):
+            self._respond_json(400, {"error": "Unknown output: %s" % output})
+            return
+
+        try:
+            body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+            image = decode_image(body, self.headers.get("Content-Type"), self.server.channels)
+        except Exception as error:
+            self._respond_json(400, {"error": str(error)})
+            return
+
+        try:
+            prediction = self.server.batcher.predict(image)
+        except Exception as error:
+            logging.exception("Prediction failed")
+            self._respond_json(500, {"error": str(error)})
+            return
+
+        self._respond(200, *encode_prediction(prediction, output, self.headers.get("Accept")))
+
+    def log_message(self, format, *args):
+        logging.debug(format % args)
+
+
+def create_server(predictor, channels, host="127.0.0.1", port=8080, max_batch_size=8, max_latency_ms=10, num_workers=1):
+    """
+    Creates the server, the batcher is started with the server
+
+    :param predictor: the predictor.Predictor running the forward passes
+    :param channels: number of channels of the net
+    """
+    server = ThreadingHTTPServer((host, port), InferenceHandler)
+    server.predictor = predictor
+    server.channels = channels
+    server.batcher = DynamicBatcher(predictor, max_batch_size=max_batch_size, max_latency_ms=max_latency_ms,
+                                    num_workers=num_workers).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves a trained unet over HTTP")
+    parser.add_argument("model_path", help="checkpoint directory or prefix, or a frozen graph (.pb)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--channels", type=int, default=1)
+    parser.add_argument("--n-class", type=int, default=6)
+    parser.add_argument("--layers", type=int, default=3)
+    parser.add_argument("--features-root", type=int, default=64)
+    parser.add_argument("--max-batch-size", type=int, default=8)
+    parser.add_argument("--max-latency-ms", type=float, default=10)
+    parser.add_argument("--num-workers", type=int, default=1, help="number of batches run concurrently")
+    parser.add_argument("--intra-op-threads", type=int, default=0)
+    parser.add_argument("--inter-op-threads", type=int, default=0)
+    args = parser.parse_args()
+
+    config = tf.ConfigProto(intra_op_parallelism_threads=args.intra_op_threads,
+                            inter_op_parallelism_threads=args.inter_op_threads)
+    if args.model_path.endswith(".pb"):
+        predictor = Predictor.from_frozen_graph(args.model_path, config=config)
+    else:
+        net = unet.Unet(channels=args.channels, n_class=args.n_class, layers=args.layers,
+                        features_root=args.features_root, summaries=False)
+        predictor = Predictor(net, args.model_path, config=config)
+
+    server = create_server(predictor, args.channels, args.host, args.port, args.max_batch_size,
+                           args.max_latency_ms, args.num_workers)
+    logging.info("Serving on http://{:}:{:}".format(args.host, args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.batcher.stop()
+        predictor.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,127 @@
+# tf_unet is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# tf_unet is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with tf_unet.  If not, see <http://www.gnu.org/licenses/>.
+
+
+'''
+Tiled sliding-window inference for images too large to push through the net
+at once. The image is split into overlapping tiles whose size is divisible by
+the total pooling factor of the net, the tiles are predicted in batches and
+the class probabilities are blended back with a linear taper in the overlap.
+
+Usage:
+predictor = Predictor(net, "trained_models/")
+prediction = predict_tiled(predictor, image, n_class=6, tile_size=256, memory_budget_mb=512)
+'''
+from __future__ import print_function, division, absolute_import, unicode_literals
+
+import numpy as np
+
+
+def pooling_multiple(layers=3, pool_size=2):
+    """
+    Factor the spatial input size has to be divisible by
+    """
+    return pool_size ** (layers - 1)
+
+
+def estimate_tile_memory(tile_size, layers=3, features_root=64, pool_size=2):
+    """
+    Rough estimate of the peak float32 activation memory of a single tile in bytes.
+    Every level keeps about six feature maps alive (convolutions, activations, dropout,
+    pooling and concatenation), the features double while the area shrinks by pool_size**2.
+
+    :param tile_size: edge length of the tile
+    """
+    maps_per_level = 6
+    values = 0
+    for layer in range(layers):
+        values += maps_per_level * features_root * 2**layer * tile_size**2 / pool_size**(2 * layer)
+    return int(4 * values)
+
+
+def _blend_window(tile_size, overlap):
+    """
+    Weights ramping linearly up over the overlap. They are never zero, such that
+    border pixels without a neighbouring tile keep a defined value
+    """
+    ramp = np.ones(tile_size, dtype=np.float32)
+    if overlap > 0:
+        edge = (np.arange(overlap, dtype=np.float32) + 1) / (overlap + 1)
+        ramp[:overlap] = edge
+        ramp[-overlap:] = edge[::-1]
+    return np.outer(ramp, ramp)
+
+
+def _tile_origins(size, tile_size, stride):
+    origins = list(range(0, size - tile_size, stride))
+    origins.append(size - tile_size)
+    return origins
+
+
+def predict_tiled(predict_fn, image, n_class, tile_size=256, overlap=32, batch_size=None, memory_budget_mb=None,
+                  layers=3, features_root=64, pool_size=2):
+    """
+    Predicts a large image tile by tile
+
+    :param predict_fn: callable mapping a batch [n, tile, tile, channels] to class probabilities [n, tile, tile, n_class],
+                       e.g. a predictor.Predictor
+    :param image: the image of shape [nx, ny, channels]
+    :param n_class: number of output labels
+    :param tile_size: (optional) edge length of the tiles, rounded up to a multiple of pool_size**(layers-1)
+    :param overlap: (optional) number of pixels neighbouring tiles overlap
+    :param batch_size: (optional) number of tiles per forward pass
+    :param memory_budget_mb: (optional) activation memory budget, used to derive the batch size if none is given
+    :param layers: (optional) number of layers in the net
+    :param features_root: (optional) number of features in the first layer
+    :param pool_size: (optional) size of the max pooling operation
+
+    :returns prediction: class probabilities of shape [nx, ny, n_class]
+    """
+    multiple = pooling_multiple(layers, pool_size)
+    tile_size = int(np.ceil(tile_size / multiple)) * multiple
+    overlap = min(overlap, tile_size // 2)
+
+    if batch_size is None:
+        if memory_budget_mb is None:
+            batch_size = 1
+        else:
+            tile_memory = estimate_tile_memory(tile_size, layers, features_root, pool_size)
+            batch_size = max(1, int(memory_budget_mb * 2**20 // tile_memory))
+
+    nx, ny = image.shape[:2]
+    # images smaller than a tile are mirrored up to the tile size
+    pad_x = max(0, tile_size - nx)
+    pad_y = max(0, tile_size - ny)
+    if pad_x or pad_y:
+        image = np.pad(image, ((0, pad_x), (0, pad_y), (0, 0)), mode="reflect")
+    px, py = image.shape[:2]
+
+    stride = tile_size - overlap
+    origins = [(x, y) for x in _tile_origins(px, tile_size, stride) for y in _tile_origins(py, tile_size, stride)]
+    window = _blend_window(tile_size, overlap)
+
+    prediction = np.zeros((px, py, n_class), dtype=np.float32)
+    weights = np.zeros((px, py), dtype=np.float32)
+    tiles = np.empty((min(batch_size, len(origins)), tile_size, tile_size, image.shape[2]), dtype=np.float32)
+    for start in range(0, len(origins), batch_size):
+        batch_origins = origins[start:start + batch_size]
+        for i, (x, y) in enumerate(batch_origins):
+            tiles[i] = image[x:x + tile_size, y:y + tile_size]
+
+        tile_predictions = predict_fn(tiles[:len(batch_origins)])
+        for (x, y), tile_prediction in zip(batch_origins, tile_predictions):
+            prediction[x:x + tile_size, y:y + tile_size] += tile_prediction * window[..., np.newaxis]
+            weights[x:x + tile_size, y:y + tile_size] += window
+
+    prediction /= weights[..., np.newaxis]
+    return prediction[:nx, :ny]
@@ -20,8 +20,8 @@ author: jakeret
 from __future__ import print_function, division, absolute_import, unicode_literals
 
 import os
-import scipy.io as sio
 import shutil
+import functools
 import numpy as np
 from collections import OrderedDict
 import logging
@@ -29,18 +29,25 @@ import logging
 import tensorflow as tf
 
 from tf_unet import util
+from tf_unet import data_store
+from tf_unet import loader
+from tf_unet import evaluation
+from tf_unet import predictor
+from tf_unet import checkpoint
+from tf_unet import profiler
 from tf_unet.layers import (weight_variable, weight_variable_devonc, bias_variable, 
                             conv2d, deconv2d, max_pool, crop_and_concat, pixel_wise_softmax_2,
-                            cross_entropy)
+                            cross_entropy, recompute_gradient)
 
 logging.basicConfig(level=logging.INFO, format='%(asctime)s %(message)s')
 
-def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16, filter_size=3, pool_size=2, summaries=True):
+def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16, filter_size=3, pool_size=2, summaries=True,
+                    recompute=False, dtype=tf.float32):
     """
     Creates a new convolutional unet for the given parametrization.
     
     :param x: input tensor, shape [?,nx,ny,channels]
-    :param keep_prob: dropout probability tensor
+    :param keep_prob: dropout probability tensor, None builds the net without dropout
     :param channels: number of channels in the input image
     :param n_class: number of output labels
     :param layers: number of layers in the net
@@ -48,6 +55,11 @@ def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16,
     :param filter_size: size of the convolution filter
     :param pool_size: size of the max pooling operation
     :param summaries: Flag if summaries should be created
+    :param recompute: Flag if the activations inside the convolution blocks should be recomputed in the
+                      backward pass instead of being stored. Only the block outputs are kept, the summaries
+                      of the convolutions and concatenations are skipped
+    :param dtype: (optional) dtype the convolutions and activations are computed in, e.g. tf.bfloat16. The
+                  variables are kept in float32 and cast at their use, the output map is cast back to float32
     """
     
     logging.info("Layers {layers}, features {features}, filter size {filter_size}x{filter_size}, pool size: {pool_size}x{pool_size}".format(layers=layers,
@@ -58,7 +70,7 @@ def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16,
     nx = tf.shape(x)[1]
     ny = tf.shape(x)[2]
     x_image = tf.reshape(x, tf.stack([-1,nx,ny,channels]))
-    in_node = x_image
+    in_node = tf.cast(x_image, dtype)
     batch_size = tf.shape(x_image)[0]
  
     weights = []
@@ -69,6 +81,19 @@ def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16,
     dw_h_convs = OrderedDict()
     up_h_convs = OrderedDict()
     
+    if recompute and keep_prob is not None:
+        # the dropout masks are drawn from seeds of the step, such that the recomputation reproduces them
+        dropout_seed = tf.random_uniform([2], maxval=2**31 - 1, dtype=tf.int64)
+        conv_seeds = lambda block: (dropout_seed + [0, 2 * block], dropout_seed + [0, 2 * block + 1])
+    else:
+        conv_seeds = lambda block: (None, None)
+    
+    def cast(*variables):
+        # float32 master weights, the gradients flow back through the casts
+        if dtype == tf.float32:
+            return variables
+        return tuple(tf.cast(variable, dtype) for variable in variables)
+    
     in_size = 1000
     size = in_size
     # down layers
@@ -84,14 +109,16 @@ def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16,
         b1 = bias_variable([features])
         b2 = bias_variable([features])
         
-        conv1 = conv2d(in_node, w1, keep_prob)
-        tmp_h_conv = tf.nn.relu(conv1 + b1)
-        conv2 = conv2d(tmp_h_conv, w2, keep_prob)
-        dw_h_convs[layer] = tf.nn.relu(conv2 + b2)
+        block_kwargs = dict(keep_prob=keep_prob, seeds=conv_seeds(layer))
+        if recompute:
+            down_block = functools.partial(_block_output, _conv_block, **block_kwargs)
+            dw_h_convs[layer] = recompute_gradient(down_block)(in_node, *cast(w1, b1, w2, b2))
+        else:
+            conv1, conv2, dw_h_convs[layer] = _conv_block(in_node, *cast(w1, b1, w2, b2), **block_kwargs)
+            convs.append((conv1, conv2))
         
         weights.append((w1, w2))
         biases.append((b1, b2))
-        convs.append((conv1, conv2))
         
         size -= 4
         if layer < layers-1:
@@ -108,24 +135,23 @@ def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16,
         
         wd = weight_variable_devonc([pool_size, pool_size, features//2, features], stddev)
         bd = bias_variable([features//2])
-        h_deconv = tf.nn.relu(deconv2d(in_node, wd, pool_size) + bd)
-        h_deconv_concat = crop_and_concat(dw_h_convs[layer], h_deconv)
-        deconv[layer] = h_deconv_concat
-        
         w1 = weight_variable([filter_size, filter_size, features, features//2], stddev)
         w2 = weight_variable([filter_size, filter_size, features//2, features//2], stddev)
         b1 = bias_variable([features//2])
         b2 = bias_variable([features//2])
         
-        conv1 = conv2d(h_deconv_concat, w1, keep_prob)
-        h_conv = tf.nn.relu(conv1 + b1)
-        conv2 = conv2d(h_conv, w2, keep_prob)
-        in_node = tf.nn.relu(conv2 + b2)
+        block_kwargs = dict(keep_prob=keep_prob, seeds=conv_seeds(layers + layer), pool_size=pool_size)
+        if recompute:
+            up_block = functools.partial(_block_output, _up_block, **block_kwargs)
+            in_node = recompute_gradient(up_block)(in_node, dw_h_convs[layer], *cast(wd, bd, w1, b1, w2, b2))
+        else:
+            deconv[layer], conv1, conv2, in_node = _up_block(in_node, dw_h_convs[layer],
+                                                             *cast(wd, bd, w1, b1, w2, b2), **block_kwargs)
+            convs.append((conv1, conv2))
         up_h_convs[layer] = in_node
 
         weights.append((w1, w2))
         biases.append((b1, b2))
-        convs.append((conv1, conv2))
         
         size *= 2
         size -= 4
@@ -133,8 +159,9 @@ def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16,
     # Output Map
     weight = weight_variable([1, 1, features_root, n_class], stddev)
     bias = bias_variable([n_class])
-    conv = conv2d(in_node, weight, tf.constant(1.0))
-    output_map = tf.nn.relu(conv + bias)
+    weight_cast, bias_cast = cast(weight, bias)
+    conv = conv2d(in_node, weight_cast, None)
+    output_map = tf.cast(tf.nn.relu(conv + bias_cast), tf.float32)
     up_h_convs["out"] = output_map
     
     if summaries:
@@ -149,10 +176,10 @@ def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16,
             tf.summary.image('summary_deconv_concat_%02d'%k, get_image_summary(deconv[k]))
             
         for k in dw_h_convs.keys():
-            tf.summary.histogram("dw_convolution_%02d"%k + '/activations', dw_h_convs[k])
+            tf.summary.histogram("dw_convolution_%02d"%k + '/activations', tf.cast(dw_h_convs[k], tf.float32))
 
         for k in up_h_convs.keys():
-            tf.summary.histogram("up_convolution_%s"%k + '/activations', up_h_convs[k])
+            tf.summary.histogram("up_convolution_%s"%k + '/activations', tf.cast(up_h_convs[k], tf.float32))
             
     variables = []
     for w1,w2 in weights:
@@ -167,6 +194,33 @@ def create_conv_net(x, keep_prob, channels, n_class, layers=3, features_root=16,
     return output_map, variables, int(in_size - size)
 
 
+def _conv_block(in_node, w1, b1, w2, b2, keep_prob, seeds=(None, None)):
+    """
+    Two convolutions with dropout and relu activations
+    
+    :returns conv1, conv2, output: the convolutions and the activation of the block
+    """
+    conv1 = conv2d(in_node, w1, keep_prob, seeds[0])
+    h_conv = tf.nn.relu(conv1 + b1)
+    conv2 = conv2d(h_conv, w2, keep_prob, seeds[1])
+    return conv1, conv2, tf.nn.relu(conv2 + b2)
+
+
+def _up_block(in_node, skip, wd, bd, w1, b1, w2, b2, keep_prob, seeds=(None, None), pool_size=2):
+    """
+    Up-convolution concatenated with the skip connection followed by a convolution block
+    
+    :returns concat, conv1, conv2, output: the concatenation, the convolutions and the activation of the block
+    """
+    h_deconv = tf.nn.relu(deconv2d(in_node, wd, pool_size) + bd)
+    h_deconv_concat = crop_and_concat(skip, h_deconv)
+    return (h_deconv_concat,) + _conv_block(h_deconv_concat, w1, b1, w2, b2, keep_prob, seeds)
+
+
+def _block_output(block, *inputs, **kwargs):
+    return block(*inputs, **kwargs)[-1]
+
+
 class Unet(object):
     """
     A unet implementation
@@ -175,83 +229,161 @@ class Unet(object):
     :param n_class: (optional) number of output labels
     :param cost: (optional) name of the cost function. Default is 'cross_entropy'
     :param cost_kwargs: (optional) kwargs passed to the cost function. See Unet._get_cost for more options
+    :param input_fn: (optional) callable returning a tf.data.Dataset of `(batch_x, batch_y)`, see input_pipeline.
+                     The placeholders default to the dataset iterator and can still be fed for ad-hoc prediction
+    :param label_format: (optional) 'one_hot' for labels of shape [n, nx, ny, n_class] or 'index' for uint8
+                         class index maps of shape [n, nx, ny], which are expanded in the graph
+    :param precision: (optional) 'float32' or 'bfloat16'. With 'bfloat16' the convolutions and activations
+                      run in bfloat16 on float32 master weights, the cost and the predictions are float32
+    :param seed: (optional) graph-level random seed, set after the default graph is reset
     """
     
-    def __init__(self, channels=3, n_class=2, cost="cross_entropy", cost_kwargs={}, **kwargs):
-        tf.reset_default_graph()
+    def __init__(self, channels=3, n_class=2, cost="cross_entropy", cost_kwargs={}, input_fn=None, label_format="one_hot",
+                 precision="float32", seed=None, **kwargs):
+        try:
+            tf.reset_default_graph()
+        except AssertionError:
+            # built inside a `with graph.as_default()` block, the net is added to that graph
+            pass
+        if seed is not None:
+            tf.set_random_seed(seed)
         
         self.n_class = n_class
+        self.label_format = label_format
+        # created on the first save or restore, see _get_saver
+        self.saver = None
+        # prediction shapes by input size, see prediction_shape
+        self._prediction_shapes = {}
         self.summaries = kwargs.get("summaries", True)
         
-        self.x = tf.placeholder("float", shape=[None, None, None, channels])
-        self.y = tf.placeholder("float", shape=[None, None, None, n_class])
-        self.keep_prob = tf.placeholder(tf.float32) #dropout (keep probability)
+        if label_format == "index":
+            y_dtype, y_shape = tf.uint8, [None, None, None]
+        elif label_format == "one_hot":
+            y_dtype, y_shape = tf.float32, [None, None, None, n_class]
+        else:
+            raise ValueError("Unknown label format: %s" % label_format)
+        
+        if precision not in ("float32", "bfloat16"):
+            raise ValueError("Unknown precision: %s" % precision)
+        self.precision = precision
         
-        logits, self.variables, self.offset = create_conv_net(self.x, self.keep_prob, channels, n_class, **kwargs)
+        if input_fn is not None:
+            self.iterator = input_fn().make_initializable_iterator()
+            x_next, y_next = self.iterator.get_next()
+            self.x = tf.placeholder_with_default(x_next, shape=[None, None, None, channels])
+            self.y = tf.placeholder_with_default(y_next, shape=y_shape)
+        else:
+            self.iterator = None
+            self.x = tf.placeholder("float", shape=[None, None, None, channels])
+            self.y = tf.placeholder(y_dtype, shape=y_shape)
         
-        self.cost = self._get_cost(logits, cost, cost_kwargs)
+        if label_format == "index":
+            self.y_one_hot = tf.one_hot(tf.cast(self.y, tf.int32), n_class)
+        else:
+            self.y_one_hot = self.y
+        self.keep_prob = tf.placeholder_with_default(1.0, shape=[]) #dropout (keep probability)
+        
+        logits, self.variables, self.offset = create_conv_net(self.x, self.keep_prob, channels, n_class,
+                                                              dtype=tf.as_dtype(precision), **kwargs)
         
-        self.gradients_node = tf.gradients(self.cost, self.variables)
+        # only created if the cost depends on the training step
+        self.global_step = None
+        self.cost = self._get_cost(logits, cost, cost_kwargs)
          
-        self.cross_entropy = tf.reduce_mean(cross_entropy(tf.reshape(self.y, [-1, n_class]),
+        self.cross_entropy = tf.reduce_mean(cross_entropy(tf.reshape(self.y_one_hot, [-1, n_class]),
                                                           tf.reshape(pixel_wise_softmax_2(logits), [-1, n_class])))
         
         self.predicter = pixel_wise_softmax_2(logits)
-        self.correct_pred = tf.equal(tf.argmax(self.predicter, 3), tf.argmax(self.y, 3))
+        self.correct_pred = tf.equal(tf.argmax(self.predicter, 3), tf.argmax(self.y_one_hot, 3))
         self.accuracy = tf.reduce_mean(tf.cast(self.correct_pred, tf.float32))
         
+        # streaming evaluation statistics, see evaluation.StreamingEvaluator
+        flat_index = tf.reshape(tf.argmax(self.y_one_hot, 3, output_type=tf.int32), [-1])
+        self.confusion_matrix = tf.confusion_matrix(flat_index,
+                                                    tf.reshape(tf.argmax(self.predicter, 3, output_type=tf.int32), [-1]),
+                                                    num_classes=n_class, dtype=tf.int64)
+        pixel_cross_entropy = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=flat_index,
+                                                                             logits=tf.reshape(logits, [-1, n_class]))
+        self.class_cross_entropy = tf.unsorted_segment_sum(pixel_cross_entropy, flat_index, n_class)
+        
     def _get_cost(self, logits, cost_name, cost_kwargs):
         """
-        Constructs the cost function, either cross_entropy, weighted cross_entropy or dice_coefficient.
+        Constructs the cost function, either cross_entropy, weighted cross_entropy, focal loss or dice_coefficient.
         Optional arguments are: 
-        class_weights: weights for the different classes in case of multi-class imbalance
+        fore_weights: weight of the background class (channel 0)
+        back_weights: weights of the remaining classes
+        loss: 'weighted' (default) for the equally-weighted cross entropy or 'focal' for the focal loss
+        focal_gamma: focusing parameter of the focal loss, default 2
+        focal_start_step: global step at which the weighted loss is switched to the focal loss
         regularizer: power of the L2 regularizers added to the loss function
+        
+        The losses are computed in one expression over the class axis on the log-softmax.
+        Class index labels are consumed directly through the sparse cross entropy.
         """
+        # the options are popped from a copy, the caller's dict may build further nets, e.g. in a functools.partial
+        cost_kwargs = dict(cost_kwargs)
         
         flat_logits = tf.reshape(logits, [-1, self.n_class])
-        flat_labels = tf.reshape(self.y, [-1, self.n_class])
+        flat_labels = tf.reshape(self.y_one_hot, [-1, self.n_class])
         if cost_name == "cross_entropy":
             fore_weights = cost_kwargs.pop("fore_weights", None)
             back_weights = cost_kwargs.pop("back_weights", None)
+            loss_name = cost_kwargs.pop("loss", "weighted")
+            focal_gamma = cost_kwargs.pop("focal_gamma", 2.0)
+            focal_start_step = cost_kwargs.pop("focal_start_step", None)
             
-            if fore_weights is not None:
-
-                # By XY
-
-                logits_softmax = tf.nn.softmax(flat_logits)
-                weight_fore = tf.constant(np.array(fore_weights, dtype=np.float32))
-                weight_back = tf.constant(np.array(back_weights, dtype=np.float32))
-                weight_map_fore = tf.multiply(flat_labels, weight_fore)
-                weight_map_back = tf.multiply(flat_labels, weight_back)
-
-                # Weighted loss - use this loss at the first-step training
-                weight_loss = -weight_map_fore[..., 0] * tf.log(logits_softmax[..., 0])
-                for i_map in range(1, self.n_class):
-                    weight_loss = weight_loss-weight_map_back[..., i_map]*tf.log(logits_softmax[..., i_map])
-                loss = tf.reduce_mean(weight_loss)
-
-                # # Focal loss - use this loss at the second-step training
-                # focal_map = tf.ones(tf.shape(logits_softmax), tf.float32) - logits_softmax
-                # focal_map_2 = tf.multiply(focal_map, focal_map)
-                # focal_loss = -weight_map_fore[..., 0]*focal_map_2[..., 0]*tf.log(logits_softmax[..., 0])# weighted background
-                # for i_map in range(1, self.n_class):
-                #     focal_loss = focal_loss-weight_map_back[..., i_map]*focal_map_2[..., i_map]*tf.log(logits_softmax[..., i_map])
-                # loss = tf.reduce_mean(focal_loss)
-
-                # By XY
-                
+            if loss_name not in ("weighted", "focal"):
+                raise ValueError("Unknown loss: %s" % loss_name)
+            
+            if fore_weights is None and loss_name == "weighted" and focal_start_step is None:
+                if self.label_format == "index":
+                    flat_index = tf.reshape(tf.cast(self.y, tf.int32), [-1])
+                    loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits=flat_logits,
+                                                                                         labels=flat_index))
+                else:
+                    loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=flat_logits, 
+                                                                                  labels=flat_labels))
             else:
-                loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits=flat_logits, 
-                                                                              labels=flat_labels))
+                class_weights = _class_weights(self.n_class,
+                                               1.0 if fore_weights is None else fore_weights,
+                                               1.0 if back_weights is None else back_weights)
+                
+                if self.label_format == "index":
+                    # log-probability and weight of the true class of every pixel
+                    flat_index = tf.reshape(tf.cast(self.y, tf.int32), [-1])
+                    log_probs = -tf.nn.sparse_softmax_cross_entropy_with_logits(logits=flat_logits, labels=flat_index)
+                    weight_map = tf.gather(class_weights, flat_index)
+                    class_sum = lambda loss_map: loss_map
+                else:
+                    log_probs = tf.nn.log_softmax(flat_logits)
+                    weight_map = flat_labels * class_weights
+                    class_sum = lambda loss_map: tf.reduce_sum(loss_map, axis=1)
+                
+                def weighted_loss():
+                    return -tf.reduce_mean(class_sum(weight_map * log_probs))
+                
+                def focal_loss():
+                    focal_map = tf.pow(1. - tf.exp(log_probs), focal_gamma)
+                    return -tf.reduce_mean(class_sum(weight_map * focal_map * log_probs))
+                
+                if focal_start_step is not None:
+                    # switches from the weighted to the focal loss inside one training run
+                    self.global_step = tf.train.get_or_create_global_step()
+                    loss = tf.cond(self.global_step >= focal_start_step, focal_loss, weighted_loss)
+                elif loss_name == "focal":
+                    loss = focal_loss()
+                else:
+                    loss = weighted_loss()
+                
         elif cost_name == "dice_coefficient":
             eps = 1e-5
             prediction = pixel_wise_softmax_2(logits)
-            intersection = tf.reduce_sum(prediction * self.y)
-            union =  eps + tf.reduce_sum(prediction) + tf.reduce_sum(self.y)
+            intersection = tf.reduce_sum(prediction * self.y_one_hot)
+            union =  eps + tf.reduce_sum(prediction) + tf.reduce_sum(self.y_one_hot)
             loss = -(2 * intersection/ (union))
             
         else:
-            raise ValueError("Unknown cost function: "%cost_name)
+            raise ValueError("Unknown cost function: %s"%cost_name)
 
         regularizer = cost_kwargs.pop("regularizer", None)
         if regularizer is not None:
@@ -262,31 +394,28 @@ class Unet(object):
 
     # def predict(self, model_path, x_test):
     # By XY
-    def predict(self, x_test):
+    def predict(self, x_test, model_path=None):
     # By XY
         """
-        Uses the model to create a prediction for the given data
+        Uses the model to create a prediction for the given data. Every call opens
+        a new session and restores the checkpoint, use predictor.Predictor for repeated inference
         
-        :param model_path: path to the model checkpoint to restore
         :param x_test: Data to predict on. Shape [n, nx, ny, channels]
+        :param model_path: checkpoint directory or prefix to restore
         :returns prediction: The unet prediction Shape [n, px, py, labels] (px=nx-self.offset/2) 
         """
         
+        if model_path is None:
+            raise ValueError("No checkpoint to restore given")
+        
         init = tf.global_variables_initializer()
         with tf.Session() as sess:
             # Initialize variables
             sess.run(init)
         
             # Restore model weights from previously saved model
-            # self.restore(sess, model_path)
-            # By XY
-            Restore_path = "/data/XIAOYUN_ZHOU/CodeRelease/IROS2018/TrainedModels" # please provede this path for checkpoint restore
-            ckpt = tf.train.get_checkpoint_state(Restore_path)
-            if ckpt and ckpt.model_checkpoint_path:
-                self.restore(sess, ckpt.model_checkpoint_path)
-            # By XY
-            y_dummy = np.empty((x_test.shape[0], x_test.shape[1], x_test.shape[2], self.n_class))
-            prediction = sess.run(self.predicter, feed_dict={self.x: x_test, self.y: y_dummy, self.keep_prob: 1.})
+            self.restore(sess, predictor.resolve_checkpoint(model_path))
+            prediction = sess.run(self.predicter, feed_dict={self.x: x_test, self.keep_prob: 1.})
             
         return prediction
     
@@ -301,10 +430,9 @@ class Unet(object):
         :param model_path: path to file system location
         """
         
-        saver = tf.train.Saver()
         # save_path = saver.save(sess, model_path)
         # By XY
-        save_path = saver.save(sess, model_path, global_step=save_step)
+        save_path = self._get_saver().save(sess, model_path, global_step=save_step)
         # By XY
         return save_path
     
@@ -316,9 +444,34 @@ class Unet(object):
         :param model_path: path to file system checkpoint location
         """
         
-        saver = tf.train.Saver()
-        saver.restore(sess, model_path)
+        self._get_saver().restore(sess, model_path)
         logging.info("Model restored from file: %s" % model_path)
+    
+    def prediction_shape(self, sess, input_shape):
+        """
+        Shape of the prediction for inputs of the given shape. The prediction is smaller than the
+        input if its size is not divisible by pool_size**(layers-1), it is computed once per input size
+        
+        :param sess: current session
+        :param input_shape: shape of the input batch [n, nx, ny, channels]
+        
+        :returns shape: the prediction shape [n, nx, ny, n_class]
+        """
+        key = tuple(input_shape[1:])
+        if key not in self._prediction_shapes:
+            probe = np.zeros((1,) + key, dtype=np.float32)
+            self._prediction_shapes[key] = sess.run(self.predicter, feed_dict={self.x: probe,
+                                                                               self.keep_prob: 1.}).shape[1:]
+        return tuple(input_shape[:1]) + self._prediction_shapes[key]
+    
+    def _get_saver(self):
+        """
+        The Saver is built once, creating one per call would add ops to the graph every time
+        """
+        if self.saver is None:
+            with self.x.graph.as_default():
+                self.saver = tf.train.Saver()
+        return self.saver
 
 class Trainer(object):
     """
@@ -329,6 +482,10 @@ class Trainer(object):
     :param norm_grads: (optional) true if normalized gradients should be added to the summaries
     :param optimizer: (optional) name of the optimizer to use (momentum or adam)
     :param opt_kwargs: (optional) kwargs passed to the learning rate (momentum opt) and to the optimizer
+    :param accumulation_steps: (optional) number of micro-batches of batch_size whose gradients are averaged
+                               into one update. The training steps count micro-batches, the global step of
+                               the learning rate schedule counts updates
+    :param prediction_path: (optional) directory the prediction images are written to, see Trainer.prediction_path
     
     """
     
@@ -337,13 +494,24 @@ class Trainer(object):
     prediction_path = "/data/XIAOYUN_ZHOU/Marker_Seg/Trained_1/prediction/"
     # By XY
     verification_batch_size = 4
+    # background writer of the prediction images while training, see util.AsyncImageWriter
+    image_writer = None
+    # only the chief writes checkpoints, summaries and images and runs the verification, see parallel.ParallelTrainer
+    is_chief = True
+    # (optional) tf.ConfigProto of the training session
+    session_config = None
     
-    def __init__(self, net, batch_size=1, norm_grads=False, optimizer="momentum", opt_kwargs={}):
+    def __init__(self, net, batch_size=1, norm_grads=False, optimizer="momentum", opt_kwargs={}, accumulation_steps=1,
+                 prediction_path=None):
         self.net = net
         self.batch_size = batch_size
         self.norm_grads = norm_grads
         self.optimizer = optimizer
         self.opt_kwargs = opt_kwargs
+        self.accumulation_steps = accumulation_steps
+        self._micro_step = 0
+        if prediction_path is not None:
+            self.prediction_path = prediction_path
         
     def _get_optimizer(self, training_iters, global_step):
         if self.optimizer == "momentum":
@@ -367,31 +535,48 @@ class Trainer(object):
             # By XY
             
             optimizer = tf.train.MomentumOptimizer(learning_rate=self.learning_rate_node, momentum=momentum,
-                                                   **self.opt_kwargs).minimize(self.net.cost, 
-                                                                                global_step=global_step)
+                                                   **self.opt_kwargs)
         elif self.optimizer == "adam":
             learning_rate = self.opt_kwargs.pop("learning_rate", 0.001)
             self.learning_rate_node = tf.Variable(learning_rate)
             
             optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate_node, 
-                                               **self.opt_kwargs).minimize(self.net.cost,
-                                                                     global_step=global_step)
+                                               **self.opt_kwargs)
         
         return optimizer
+    
+    def _get_norm_gradients(self, grads_and_vars):
+        """
+        Keeps the running average of the gradients in the graph and returns the op
+        updating it together with the norms of the averaged gradients
+        """
+        grads_and_vars = [(gradient, variable) for gradient, variable in grads_and_vars if gradient is not None]
+        self.norm_gradients_node = tf.Variable(tf.constant(0.0, shape=[len(grads_and_vars)]), trainable=False)
+        
+        count = tf.Variable(0.0, trainable=False)
+        new_count = tf.assign_add(count, 1.0)
+        norms = []
+        for gradient, variable in grads_and_vars:
+            avg_gradient = tf.Variable(tf.zeros(variable.get_shape()), trainable=False)
+            updated = tf.assign(avg_gradient, avg_gradient * (1.0 - 1.0 / new_count) + gradient / new_count)
+            norms.append(tf.norm(updated))
+        
+        return tf.assign(self.norm_gradients_node, tf.stack(norms))
         
     def _initialize(self, training_iters, output_path, restore):
-        global_step = tf.Variable(0)
+        # the net owns the global step if its loss is scheduled on it
+        global_step = self.net.global_step if self.net.global_step is not None else tf.Variable(0)
         
-        self.norm_gradients_node = tf.Variable(tf.constant(0.0, shape=[len(self.net.gradients_node)]))
+        optimizer = self._get_optimizer(training_iters, global_step)
+        grads_and_vars, self.optimizer = self._build_train_op(optimizer, global_step)
         
         if self.net.summaries and self.norm_grads:
+            self.optimizer = tf.group(self.optimizer, self._get_norm_gradients(grads_and_vars))
             tf.summary.histogram('norm_grads', self.norm_gradients_node)
 
         tf.summary.scalar('loss', self.net.cost)
         tf.summary.scalar('cross_entropy', self.net.cross_entropy)
         tf.summary.scalar('accuracy', self.net.accuracy)
-
-        self.optimizer = self._get_optimizer(training_iters, global_step)
         tf.summary.scalar('learning_rate', self.learning_rate_node)
 
         self.summary_op = tf.summary.merge_all()        
@@ -400,6 +585,9 @@ class Trainer(object):
         prediction_path = os.path.abspath(self.prediction_path)
         output_path = os.path.abspath(output_path)
         
+        if not self.is_chief:
+            return init
+        
         if not restore:
             logging.info("Removing '{:}'".format(prediction_path))
             shutil.rmtree(prediction_path, ignore_errors=True)
@@ -415,23 +603,92 @@ class Trainer(object):
             os.makedirs(output_path)
         
         return init
+    
+    def _build_train_op(self, optimizer, global_step):
+        """
+        Builds the update of the variables
+        
+        :returns grads_and_vars, train_op: the gradients the update is computed from and the update op
+        """
+        # a single backward pass shared by the update and the gradient statistics
+        grads_and_vars = optimizer.compute_gradients(self.net.cost)
+        if self.accumulation_steps == 1:
+            return grads_and_vars, optimizer.apply_gradients(grads_and_vars, global_step=global_step)
+        
+        # the gradients of the micro-batches are summed up in-graph, the last micro-batch
+        # of an update adds its gradients, applies the average and resets the sums
+        grads_and_vars = [(gradient, variable) for gradient, variable in grads_and_vars if gradient is not None]
+        accumulators = [tf.Variable(tf.zeros(variable.get_shape()), trainable=False) for _, variable in grads_and_vars]
+        self._accumulate_op = tf.group(*[tf.assign_add(accumulator, gradient)
+                                         for accumulator, (gradient, _) in zip(accumulators, grads_and_vars)])
+        
+        averaged = [(tf.assign_add(accumulator, gradient) / self.accumulation_steps, variable)
+                    for accumulator, (gradient, variable) in zip(accumulators, grads_and_vars)]
+        apply_op = optimizer.apply_gradients(averaged, global_step=global_step)
+        with tf.control_dependencies([apply_op]):
+            train_op = tf.group(*[tf.assign(accumulator, tf.zeros_like(accumulator)) for accumulator in accumulators])
+        return averaged, train_op
+    
+    def _train_step(self, sess, feed_dict, options=None, run_metadata=None):
+        """
+        Runs a single optimization step
+        
+        :returns loss, lr: the loss of the batch and the learning rate
+        """
+        train_op = self.optimizer
+        if self.accumulation_steps > 1:
+            self._micro_step += 1
+            if self._micro_step % self.accumulation_steps != 0:
+                train_op = self._accumulate_op
+        
+        _, loss, lr = sess.run((train_op, self.net.cost, self.learning_rate_node), 
+                               feed_dict=feed_dict, options=options, run_metadata=run_metadata)
+        return loss, lr
+    
+    def _synchronize(self, sess):
+        """
+        Hook called once the variables are initialized or restored, see parallel.ParallelTrainer
+        """
+        pass
+    
+    def _open_sources(self, Data_path, Train_num, Veri_num):
+        return _open_sources(Data_path, Train_num, Veri_num)
 
     # def train(self, data_provider, output_path, training_iters=10, epochs=100, dropout=0.75, display_step=1, restore=False, write_graph=False):
     # By XY
     def train(self, Unet_path, Data_path, Train_num, Veri_num,
-              training_iters=10, epochs=100, dropout=0.75, display_step=1, restore=False, write_graph=False):
+              training_iters=10, epochs=100, dropout=0.75, display_step=1, restore=False, write_graph=False,
+              num_workers=2, prefetch=4, use_processes=False, augmenter=None, full_verification=True,
+              restore_path=None, checkpoint_kwargs={}, drop_predictions=True, profiler_kwargs={}):
     # By XY
         """
         Lauches the training process
         
-        :param data_provider: callable returning training and verification data
-        :param output_path: path where to store checkpoints
+        :param Unet_path: path where to store checkpoints
+        :param Data_path: directory containing the .mat files or a packed store (see data_store),
+                          alternatively a callable data provider (see image_util)
+        :param Train_num: number of training samples
+        :param Veri_num: number of verification samples
         :param training_iters: number of training mini batch iteration
         :param epochs: number of epochs
         :param dropout: dropout probability
         :param display_step: number of steps till outputting stats
         :param restore: Flag if previous model should be restored 
+        :param restore_path: (optional) checkpoint directory or prefix restored from, defaults to the output path
         :param write_graph: Flag if the computation graph should be written as protobuf file to the output path
+        :param num_workers: number of background workers loading the training batches
+        :param prefetch: maximal number of batches loaded ahead
+        :param use_processes: Flag if the workers should be processes instead of threads
+        :param augmenter: (optional) batch augmenter applied to the training batches, see augment.BatchAugmenter
+        :param full_verification: Flag if the whole verification set should be evaluated after every epoch
+        :param checkpoint_kwargs: (optional) kwargs passed to the checkpoint.CheckpointManager, e.g. the retention
+                                  (max_to_keep, keep_best, metric) and the save interval (save_steps, save_secs).
+                                  By default a checkpoint is written after every epoch. The interval is checked at
+                                  the end of the epochs, hence it is rounded up to whole epochs
+        :param drop_predictions: Flag if prediction images should be dropped instead of stalling the training
+                                 when the background writer falls behind
+        :param profiler_kwargs: (optional) kwargs passed to the profiler.StepProfiler, e.g. trace_steps to write
+                                Chrome traces of sampled steps. The timings are logged to profile.jsonl in the output path
         """
         # save_path = os.path.join(output_path, "model.cpkt")
         # if epochs == 0:
@@ -444,165 +701,222 @@ class Trainer(object):
         # By XY
         
         init = self._initialize(training_iters, output_path, restore)
+        if self.is_chief:
+            checkpoints = checkpoint.CheckpointManager(output_path, **checkpoint_kwargs)
+            self.image_writer = util.AsyncImageWriter(drop_on_full=drop_predictions)
+            profiler_kwargs = dict(dict(log_path=os.path.join(output_path, "profile.jsonl"), trace_path=output_path),
+                                   **profiler_kwargs)
+            step_profiler = profiler.StepProfiler(**profiler_kwargs)
+        else:
+            step_profiler = profiler.StepProfiler()
         
-        with tf.Session() as sess:
-            if write_graph:
-                tf.train.write_graph(sess.graph_def, output_path, "graph.pb", False)
+        train_data, veri_data = self._open_sources(Data_path, Train_num, Veri_num)
+        
+        # the background loader, checkpoint and image writers are shut down also if a step fails,
+        # such that a pending checkpoint is still written
+        train_loader = None
+        try:
+            with tf.Session(config=self.session_config) as sess:
+                if write_graph and self.is_chief:
+                    tf.train.write_graph(sess.graph_def, output_path, "graph.pb", False)
             
-            sess.run(init)
+                sess.run(init)
+                if self.net.iterator is not None:
+                    sess.run(self.net.iterator.initializer)
             
-            if restore:
-                # ckpt = tf.train.get_checkpoint_state(output_path)
+                if restore:
+                    restore_path = output_path if restore_path is None else restore_path
+                    ckpt = tf.train.latest_checkpoint(restore_path) if os.path.isdir(restore_path) else restore_path
+                    if ckpt:
+                        self.net.restore(sess, ckpt)
+                    else:
+                        logging.info("No checkpoint found in '{:}'".format(restore_path))
+                self._synchronize(sess)
+            
+                # test_x, test_y = data_provider(self.verification_batch_size)
+                # pred_shape = self.store_prediction(sess, test_x, test_y, "_init")
                 # By XY
-                Restore_path = "/data/XIAOYUN_ZHOU/Marker_Seg/Trained_1/restore" # please provide this path for checkpoint restore
-                ckpt = tf.train.get_checkpoint_state(Restore_path)
+                # test_x, test_y = Veri_data(self.batch_size)
+                test_x, test_y = loader.sample_batch(veri_data, self.batch_size)
+                pred_shape, _ = self.store_prediction(sess, test_x, test_y, "_init")
                 # By XY
-                if ckpt and ckpt.model_checkpoint_path:
-                    self.net.restore(sess, ckpt.model_checkpoint_path)
-            
-            # test_x, test_y = data_provider(self.verification_batch_size)
-            # pred_shape = self.store_prediction(sess, test_x, test_y, "_init")
-            # By XY
-            # test_x, test_y = Veri_data(self.batch_size)
-            idx = np.random.choice(Veri_num)+1
-            Image_t = sio.loadmat(Data_path + "Marker_image_verification_augment_%s.mat"%(idx))
-            test_x = Image_t['Marker_image_verification_augment']
-            test_x = np.reshape(test_x, (1, test_x.shape[0], test_x.shape[1], 1))
-            Label_t = sio.loadmat(Data_path + "Marker_label_verification_multipleclass_augment_%s.mat"%(idx))
-            test_y = Label_t['Marker_label_verification_multipleclass_augment']
-            test_y = np.reshape(test_y, (1, test_y.shape[0], test_y.shape[1], test_y.shape[2]))
-            pred_shape, _ = self.store_prediction(sess, test_x, test_y, "_init")
-            # By XY
             
-            summary_writer = tf.summary.FileWriter(output_path, graph=sess.graph)
-            logging.info("Start optimization")
+                if self.is_chief:
+                    summary_writer = tf.summary.FileWriter(output_path, graph=sess.graph)
+                if self.net.iterator is None:
+                    train_loader = loader.PrefetchLoader(train_data, batch_size=self.batch_size, num_workers=num_workers,
+                                                         queue_size=prefetch, use_processes=use_processes,
+                                                         augmenter=augmenter,
+                                                         transform=loader.CropLabels(pred_shape)).start()
+                else:
+                    # the batches are read in-graph from the net's input pipeline
+                    train_loader = None
+                evaluator = evaluation.StreamingEvaluator(self.net, self.verification_batch_size)
+                logging.info("Start optimization")
             
-            avg_gradients = None
-            for epoch in range(epochs):
-                total_loss = 0
-                for step in range((epoch*training_iters), ((epoch+1)*training_iters)):
-                    # batch_x, batch_y = data_provider(self.batch_size)
-                    idx = np.random.choice(Train_num)+1
-                    Image_t = sio.loadmat(Data_path + "Marker_image_train_augment_%s.mat" % (idx))
-                    batch_x = Image_t['Marker_image_train_augment']
-                    batch_x = np.reshape(batch_x, (1, batch_x.shape[0], batch_x.shape[1], 1))
-                    Label_t = sio.loadmat(Data_path + "Marker_label_train_multipleclass_augment_%s.mat" % (idx))
-                    batch_y = Label_t['Marker_label_train_multipleclass_augment']
-                    batch_y = np.reshape(batch_y, (1, batch_y.shape[0], batch_y.shape[1], batch_y.shape[2]))
+                for epoch in range(epochs):
+                    total_loss = 0
+                    for step in range((epoch*training_iters), ((epoch+1)*training_iters)):
+                        # batch_x, batch_y = data_provider(self.batch_size)
+                        feed_dict = {self.net.keep_prob: dropout}
+                        if train_loader is not None:
+                            with step_profiler.phase("load"):
+                                batch_x, batch_y = train_loader.next()
+                            feed_dict[self.net.x] = batch_x
+                            feed_dict[self.net.y] = batch_y
                      
-                    # Run optimization op (backprop)
-                    _, loss, lr, gradients = sess.run((self.optimizer, self.net.cost, self.learning_rate_node, self.net.gradients_node), 
-                                                      feed_dict={self.net.x: batch_x,
-                                                                 self.net.y: util.crop_to_shape(batch_y, pred_shape),
-                                                                 self.net.keep_prob: dropout})
-
-                    if self.net.summaries and self.norm_grads:
-                        avg_gradients = _update_avg_gradients(avg_gradients, gradients, step)
-                        norm_gradients = [np.linalg.norm(gradient) for gradient in avg_gradients]
-                        self.norm_gradients_node.assign(norm_gradients).eval()
+                        # Run optimization op (backprop)
+                        options, run_metadata = step_profiler.run_options(step)
+                        with step_profiler.phase("run"):
+                            loss, lr = self._train_step(sess, feed_dict, options, run_metadata)
+                        step_profiler.end_step(step, run_metadata, loss=float(loss))
                     
-                    # if step % display_step == 0:
-                    #     self.output_minibatch_stats(sess, summary_writer, step, batch_x, util.crop_to_shape(batch_y, pred_shape))
+                        # if step % display_step == 0:
+                        #     self.output_minibatch_stats(sess, summary_writer, step, batch_x, util.crop_to_shape(batch_y, pred_shape))
                         
-                    total_loss += loss
-
-                self.output_epoch_stats(epoch, total_loss, training_iters, lr)
-                # self.store_prediction(sess, test_x, test_y, "epoch_%s" % epoch)
-                # By XY
-                # test_x_tmp, test_y_tmp = Veri_data(self.batch_size)
-                idx = np.random.choice(Veri_num)+1
-                Image_t = sio.loadmat(Data_path + "Marker_image_verification_augment_%s.mat" % (idx))
-                test_x_tmp = Image_t['Marker_image_verification_augment']
-                test_x_tmp = np.reshape(test_x_tmp, (1, test_x_tmp.shape[0], test_x_tmp.shape[1], 1))
-                Label_t = sio.loadmat(Data_path + "Marker_label_verification_multipleclass_augment_%s.mat" % (idx))
-                test_y_tmp = Label_t['Marker_label_verification_multipleclass_augment']
-                test_y_tmp = np.reshape(test_y_tmp, (1, test_y_tmp.shape[0], test_y_tmp.shape[1], test_y_tmp.shape[2]))
-                _, prediction_tmp = self.store_prediction(sess, test_x_tmp, test_y_tmp, "epoch_%s"%epoch)
-                # for i_tmp in range(0, 6):
-                #     print(np.amin(prediction_tmp[..., i_tmp]))
-                # By XY
+                        total_loss += loss
+                
+                    if not self.is_chief:
+                        continue
+
+                    self.output_epoch_stats(epoch, total_loss, training_iters, lr, step_profiler)
+                    if train_loader is not None:
+                        self.output_loader_stats(train_loader)
+                    # self.store_prediction(sess, test_x, test_y, "epoch_%s" % epoch)
+                    # By XY
+                    # test_x_tmp, test_y_tmp = Veri_data(self.batch_size)
+                    with step_profiler.phase("prediction"):
+                        test_x_tmp, test_y_tmp = loader.sample_batch(veri_data, self.batch_size)
+                        _, prediction_tmp = self.store_prediction(sess, test_x_tmp, test_y_tmp, "epoch_%s"%epoch)
+                    metrics = None
+                    if full_verification:
+                        with step_profiler.phase("verification"):
+                            metrics = evaluator.evaluate(sess, veri_data)
+                        self.output_verification_stats(epoch, metrics)
+                    # for i_tmp in range(0, 6):
+                    #     print(np.amin(prediction_tmp[..., i_tmp]))
+                    # By XY
                     
-                # save_path = self.net.save(sess, save_path)
-                # By XY
-                save_path = self.net.save(sess, Initial_path, epoch)
-                # By XY
-            logging.info("Optimization Finished!")
+                    # save_path = self.net.save(sess, save_path)
+                    # By XY
+                    with step_profiler.phase("checkpoint"):
+                        checkpoints.maybe_save(sess, step + 1, metrics)
+                    # By XY
+                    step_profiler.end_epoch(epoch, loss=total_loss / training_iters)
             
-            return save_path
+                if self.is_chief and checkpoints.last_step != step + 1:
+                    checkpoints.save(sess, step + 1, metrics)
+        finally:
+            if train_loader is not None:
+                train_loader.stop()
+            step_profiler.close()
+            if self.is_chief:
+                self.image_writer.close()
+                self.image_writer = None
+                checkpoints.close()
+        
+        save_path = checkpoints.checkpoints[-1][0] if self.is_chief else None
+        logging.info("Optimization Finished!")
+        
+        return save_path
         
     def store_prediction(self, sess, batch_x, batch_y, name):
-        prediction = sess.run(self.net.predicter, feed_dict={self.net.x: batch_x, 
-                                                             self.net.y: batch_y, 
-                                                             self.net.keep_prob: 1.})
+        # the labels are cropped to the prediction beforehand, such that prediction and loss
+        # come out of a single forward pass
+        batch_y = util.crop_to_shape(batch_y, self.net.prediction_shape(sess, batch_x.shape))
+        prediction, loss = sess.run((self.net.predicter, self.net.cost), feed_dict={self.net.x: batch_x, 
+                                                                                  self.net.y: batch_y, 
+                                                                                  self.net.keep_prob: 1.})
         pred_shape = prediction.shape
         
-        loss = sess.run(self.net.cost, feed_dict={self.net.x: batch_x, 
-                                                       self.net.y: util.crop_to_shape(batch_y, pred_shape), 
-                                                       self.net.keep_prob: 1.})
-        
         logging.info("Verification loss= {:.4f}".format(loss))
               
         # img = util.combine_img_prediction(batch_x, batch_y, prediction)
         # util.save_image(img, "%s/%s.jpg"%(self.prediction_path, name))
-        img_0, img_1, img_2, img_3, img_4, img_5 = util.combine_img_prediction(batch_x, batch_y, prediction)
-        util.save_image(img_0, "%s/%s_1.jpg" % (self.prediction_path, name))
-        util.save_image(img_1, "%s/%s_2.jpg" % (self.prediction_path, name))
-        util.save_image(img_2, "%s/%s_3.jpg" % (self.prediction_path, name))
-        util.save_image(img_3, "%s/%s_4.jpg" % (self.prediction_path, name))
-        util.save_image(img_4, "%s/%s_5.jpg" % (self.prediction_path, name))
-        util.save_image(img_5, "%s/%s_6.jpg" % (self.prediction_path, name))
+        if not self.is_chief:
+            return pred_shape, prediction
+        img = util.combine_img_prediction(batch_x, batch_y, prediction)
+        for class_idx in range(len(img)):
+            path = "%s/%s_%s.jpg" % (self.prediction_path, name, class_idx + 1)
+            if self.image_writer is not None:
+                self.image_writer.save(img[class_idx], path)
+            else:
+                util.save_image(img[class_idx], path)
         
         # return pred_shape
         # By XY
         return pred_shape, prediction
         # By XY
-    def output_epoch_stats(self, epoch, total_loss, training_iters, lr):
+    def output_epoch_stats(self, epoch, total_loss, training_iters, lr, step_profiler=None):
         # logging.info("Epoch {:}, Average loss: {:.4f}, learning rate: {:.4f}".format(epoch, (total_loss / training_iters), lr))
         # By XY
         logging.info("Epoch {:}, learning rate: {:.8f}, Average loss: {:.12f},".format(epoch, lr, (total_loss / training_iters)))
         # By XY
+        if step_profiler is not None:
+            for name, stats in step_profiler.stats().items():
+                logging.info("Time {:}: mean {:.1f}ms, p50 {:.1f}ms, p90 {:.1f}ms, p99 {:.1f}ms".format(name,
+                                                                                                     stats["mean"],
+                                                                                                     stats["p50"],
+                                                                                                     stats["p90"],
+                                                                                                     stats["p99"]))
+    
+    def output_verification_stats(self, epoch, metrics):
+        logging.info("Epoch {:}, Verification loss= {:.6f}, accuracy= {:.4f}, mean Dice= {:.4f}, mean IoU= {:.4f}".format(epoch,
+                                                                                                                       metrics["loss"],
+                                                                                                                       metrics["accuracy"],
+                                                                                                                       metrics["mean_dice"],
+                                                                                                                       metrics["mean_iou"]))
+        logging.info("Per class Dice: {:}, IoU: {:}, cross entropy: {:}".format(np.array2string(metrics["dice"], precision=4),
+                                                                              np.array2string(metrics["iou"], precision=4),
+                                                                              np.array2string(metrics["cross_entropy"], precision=4)))
+    
+    def output_loader_stats(self, train_loader):
+        stats = train_loader.stats()
+        logging.info("Input stalled {:.2f}s in total, {:.4f}s per batch ({:.1%} of the time)".format(stats["stall_time"],
+                                                                                                     stats["mean_stall"],
+                                                                                                     stats["stall_fraction"]))
     
     def output_minibatch_stats(self, sess, summary_writer, step, batch_x, batch_y):
         # Calculate batch loss and accuracy
-        summary_str, loss, acc, predictions = sess.run([self.summary_op, 
-                                                            self.net.cost, 
-                                                            self.net.accuracy, 
-                                                            self.net.predicter], 
-                                                           feed_dict={self.net.x: batch_x,
-                                                                      self.net.y: batch_y,
-                                                                      self.net.keep_prob: 1.})
+        summary_str, loss, acc = sess.run([self.summary_op, 
+                                           self.net.cost, 
+                                           self.net.accuracy], 
+                                          feed_dict={self.net.x: batch_x,
+                                                     self.net.y: batch_y,
+                                                     self.net.keep_prob: 1.})
         summary_writer.add_summary(summary_str, step)
         summary_writer.flush()
         logging.info("Iter {:}, Minibatch Loss= {:.4f}, Training Accuracy= {:.4f}, Minibatch error= {:.1f}%".format(step,
                                                                                                             loss,
                                                                                                             acc,
-                                                                                                            error_rate(predictions, batch_y)))
+                                                                                                            100.0 * (1 - acc)))
 
-def _update_avg_gradients(avg_gradients, gradients, step):
-    if avg_gradients is None:
-        avg_gradients = [np.zeros_like(gradient) for gradient in gradients]
-    for i in range(len(gradients)):
-        avg_gradients[i] = (avg_gradients[i] * (1.0 - (1.0 / (step+1)))) + (gradients[i] / (step+1))
-        
-    return avg_gradients
+def _class_weights(n_class, fore_weights, back_weights):
+    """
+    Per class loss weights, the background class is weighted with `fore_weights`
+    and the remaining classes with `back_weights`. Both may be scalars or per class lists
+    """
+    fore = np.broadcast_to(np.array(fore_weights, dtype=np.float32), [n_class])
+    back = np.broadcast_to(np.array(back_weights, dtype=np.float32), [n_class])
+    return tf.constant(np.concatenate((fore[:1], back[1:])))
 
-def error_rate(predictions, labels):
+def _open_sources(Data_path, Train_num, Veri_num):
     """
-    Return the error rate based on dense predictions and 1-hot labels.
+    Opens the training and verification sources. A callable data provider is used for both
     """
+    if callable(Data_path):
+        return Data_path, Data_path
     
-    return 100.0 - (
-        100.0 *
-        np.sum(np.argmax(predictions, 3) == np.argmax(labels, 3)) /
-        (predictions.shape[0]*predictions.shape[1]*predictions.shape[2]))
-
+    # Data_path either holds the .mat files or a store packed with data_store.pack_mat_directory
+    return (data_store.open_dataset(Data_path, "train", Train_num),
+            data_store.open_dataset(Data_path, "verification", Veri_num))
 
 def get_image_summary(img, idx=0):
     """
     Make an image summary for 4d tensor image with index idx
     """
     
-    V = tf.slice(img, (0, 0, 0, idx), (1, -1, -1, 1))
+    V = tf.cast(tf.slice(img, (0, 0, 0, idx), (1, -1, -1, 1)), tf.float32)
     V -= tf.reduce_min(V)
     V /= tf.reduce_max(V)
     V *= 255
@@ -18,9 +18,34 @@ Created on Aug 10, 2016
 author: jakeret
 '''
 from __future__ import print_function, division, absolute_import, unicode_literals
+import logging
+import threading
+from collections import OrderedDict
+
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
 import numpy as np
 from PIL import Image
 
+def latency_stats(timings):
+    """
+    Mean and percentiles of wall-clock timings
+    
+    :param timings: the timings in seconds
+    
+    :returns stats: dict with the 'mean', 'p50', 'p90' and 'p99' in milliseconds, empty without timings
+    """
+    timings = 1000 * np.array(timings)
+    stats = OrderedDict()
+    if len(timings) > 0:
+        stats["mean"] = float(np.mean(timings))
+        for q in (50, 90, 99):
+            stats["p%s" % q] = float(np.percentile(timings, q))
+    return stats
+
 def plot_prediction(x_test, y_test, prediction, save=False):
     import matplotlib
     import matplotlib.pyplot as plt
@@ -92,20 +117,43 @@ def crop_to_shape(data, shape):
     offset1 = (data.shape[2] - shape[2])//2
     # return data[:, offset0:(-offset0), offset1:(-offset1)]
     # By XY
-    if offset0 == 0 and offset1 == 0:
+    if data.shape[1] == shape[1] and data.shape[2] == shape[2]:
         return data
     else:
-        return data[:, offset0:(-offset0), offset1:(-offset1)]
+        # the size differences may be odd or zero in one dimension only
+        return data[:, offset0:offset0 + shape[1], offset1:offset1 + shape[2]]
     # By XY
+def to_class_index(labels):
+    """
+    Converts one-hot labels into a compact class index map
+    
+    :param labels: the one-hot labels [..., n_class]
+    
+    :returns index: uint8 class index map [...]
+    """
+    return np.argmax(labels, axis=-1).astype(np.uint8)
+
+def to_one_hot(index, n_class, dtype=np.float32):
+    """
+    Expands a class index map into one-hot labels
+    
+    :param index: the class index map [...]
+    :param n_class: number of classes
+    
+    :returns labels: the one-hot labels [..., n_class]
+    """
+    return np.eye(n_class, dtype=dtype)[index]
+
 def combine_img_prediction(data, gt, pred):
     """
-    Combines the data, grouth thruth and the prediction into one rgb image
+    Combines the data, grouth thruth and the prediction into one rgb image per class.
+    The panels of all classes are built at once
     
     :param data: the data tensor
-    :param gt: the ground thruth tensor
+    :param gt: the ground thruth tensor, one-hot [n, nx, ny, n_class] or class indices [n, nx, ny]
     :param pred: the prediction tensor
     
-    :returns img: the concatenated rgb image 
+    :returns img: the rgb images [n_class, n*nx, 3*ny, 3], one per class
     """
     # ny = pred.shape[2]
     # ch = data.shape[3]
@@ -113,36 +161,26 @@ def combine_img_prediction(data, gt, pred):
     #                       to_rgb(crop_to_shape(gt[..., 1], pred.shape).reshape(-1, ny, 1)),
     #                       to_rgb(pred[..., 1].reshape(-1, ny, 1))), axis=1)
     # return img
-    # By XY
+    n_class = pred.shape[3]
     ny = pred.shape[2]
     ch = data.shape[3]
-    Channel_num = 0
-    img_0 = np.concatenate((to_rgb(crop_to_shape(data, pred.shape).reshape(-1, ny, ch)),
-                            to_rgb(crop_to_shape(gt[..., Channel_num], pred.shape).reshape(-1, ny, 1)),
-                            to_rgb(pred[..., Channel_num].reshape(-1, ny, 1))), axis=1)
-
-    Channel_num = 1
-    img_1 = np.concatenate((to_rgb(crop_to_shape(data, pred.shape).reshape(-1, ny, ch)),
-                          to_rgb(crop_to_shape(gt[..., Channel_num], pred.shape).reshape(-1, ny, 1)),
-                          to_rgb(pred[..., Channel_num].reshape(-1, ny, 1))), axis=1)
-    Channel_num = 2
-    img_2 = np.concatenate((to_rgb(crop_to_shape(data, pred.shape).reshape(-1, ny, ch)),
-                          to_rgb(crop_to_shape(gt[..., Channel_num], pred.shape).reshape(-1, ny, 1)),
-                          to_rgb(pred[..., Channel_num].reshape(-1, ny, 1))), axis=1)
-    Channel_num = 3
-    img_3 = np.concatenate((to_rgb(crop_to_shape(data, pred.shape).reshape(-1, ny, ch)),
-                          to_rgb(crop_to_shape(gt[..., Channel_num], pred.shape).reshape(-1, ny, 1)),
-                          to_rgb(pred[..., Channel_num].reshape(-1, ny, 1))), axis=1)
-    Channel_num = 4
-    img_4 = np.concatenate((to_rgb(crop_to_shape(data, pred.shape).reshape(-1, ny, ch)),
-                          to_rgb(crop_to_shape(gt[..., Channel_num], pred.shape).reshape(-1, ny, 1)),
-                          to_rgb(pred[..., Channel_num].reshape(-1, ny, 1))), axis=1)
-    Channel_num = 5
-    img_5 = np.concatenate((to_rgb(crop_to_shape(data, pred.shape).reshape(-1, ny, ch)),
-                          to_rgb(crop_to_shape(gt[..., Channel_num], pred.shape).reshape(-1, ny, 1)),
-                          to_rgb(pred[..., Channel_num].reshape(-1, ny, 1))), axis=1)
-    return img_0, img_1, img_2, img_3, img_4, img_5
-    # By XY
+    
+    # the data panel is the same for every class and only converted once
+    data_rgb = to_rgb(np.array(crop_to_shape(data, pred.shape).reshape(-1, ny, ch), dtype=np.float32))
+    
+    gt = crop_to_shape(gt, pred.shape)
+    if gt.ndim == 3:
+        gt = gt[..., np.newaxis] == np.arange(n_class)
+    
+    img = np.empty((n_class, data_rgb.shape[0], 3 * ny, 3), dtype=np.float32)
+    img[:, :, :ny] = data_rgb
+    img[:, :, ny:2 * ny] = np.moveaxis(gt, -1, 0).reshape(n_class, -1, ny, 1)
+    img[:, :, 2 * ny:] = np.moveaxis(pred, -1, 0).reshape(n_class, -1, ny, 1)
+    
+    label_panels = img[:, :, ny:]
+    label_panels[np.isnan(label_panels)] = 0
+    label_panels *= 255
+    return img
 
 def save_image(img, path):
     """
@@ -153,3 +191,55 @@ def save_image(img, path):
     """
     Image.fromarray(img.round().astype(np.uint8)).save(path, 'JPEG', dpi=[300,300], quality=90)
 
+
+
+class AsyncImageWriter(object):
+    """
+    Writes images from a background thread, see save_image
+    
+    :param queue_size: (optional) maximal number of images waiting to be written
+    :param drop_on_full: (optional) Flag if images should be dropped instead of blocking if the queue is full
+    """
+    
+    def __init__(self, queue_size=16, drop_on_full=True):
+        self.drop_on_full = drop_on_full
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = threading.Thread(target=self._write_loop)
+        self._thread.daemon = True
+        self._thread.start()
+    
+    def save(self, img, path):
+        """
+        Queues the image, the array must not be modified afterwards
+        
+        :returns queued: Flag if the image was queued, False if it was dropped
+        """
+        try:
+            self._queue.put((img, path), block=not self.drop_on_full)
+        except queue.Full:
+            self.dropped += 1
+            return False
+        return True
+    
+    def _write_loop(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+            img, path = item
+            try:
+                save_image(img, path)
+            except Exception:
+                logging.exception("Writing image '{:}' failed".format(path))
+    
+    def close(self):
+        """
+        Writes the queued images and stops the writer
+        """
+        if self._thread is not None:
+            self._queue.put(None)
+            self._thread.join()
+            self._thread = None
+            if self.dropped:
+                logging.info("Dropped {:} images".format(self.dropped))